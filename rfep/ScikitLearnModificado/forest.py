@@ -1,6 +1,5 @@
 # coding=utf-8
 import numbers
-import threading
 from warnings import warn
 import numpy as np
 from sklearn.ensemble import RandomForestRegressor
@@ -8,16 +7,31 @@ from sklearn.ensemble.base import _partition_estimators
 from sklearn.tree._tree import issparse, DOUBLE, DTYPE
 from sklearn.utils import check_array, check_random_state
 from sklearn.utils.fixes import _joblib_parallel_args
-from sklearn.utils.validation import check_is_fitted
+from sklearn.utils.validation import check_is_fitted, _num_samples
+from scipy.sparse import csc_matrix
 import time
-from joblib import Parallel, load, delayed, dump
+from joblib import Parallel, load, delayed, dump, effective_n_jobs
 import os
 import tempfile
 import gc
 
 class Forest(RandomForestRegressor):
 
-    def predict(self, X, mask):
+    def fit(self, X, y, sample_weight=None):
+        """
+        Fits the forest as RandomForestRegressor does and then packs the
+        out-of-bag samples of every tree in oob_bitmap_, so that OOB
+        prediction never has to regenerate the bootstraps.
+        """
+        super().fit(X, y, sample_weight)
+
+        self.flat_forest_ = None
+        self.oob_bitmap_ = None
+        self.__oob_bitmap(_num_samples(X))
+
+        return self
+
+    def predict(self, X, mask, check_input=True):
         """Predict regression target for X.
         The predicted regression target of an input sample is computed as the
         mean predicted regression targets of the trees in the forest.
@@ -32,6 +46,10 @@ class Forest(RandomForestRegressor):
 
         fileCache : Rota onde se encontra as arvores que seram trabalhadas, lembrando que cada colecao e cada fold
             possui um conjunto unico de arvores
+
+        check_input : False skips the validation of X, which must then
+            already be a C-contiguous float32 array or a float32 csr_matrix,
+            as DatasetHandler loads them. Saves a full pass over X per call.
         Returns
         -------
         y : array of shape = [n_samples] or [n_samples, n_outputs]
@@ -45,78 +63,114 @@ class Forest(RandomForestRegressor):
         check_is_fitted(self, 'estimators_')
 
         # Check data
-        X = self._validate_X_predict(X)
+        if check_input:
+            X = self._validate_X_predict(X)
 
-        # Assign chunk of trees to jobs
-        n_jobs, _, _ = _partition_estimators(self.n_estimators, self.n_jobs)
+        # Only the trees kept by the chromosome are traversed
+        trees = np.flatnonzero(mask)
+        flat_forest = self.__flat_forest()
 
-        # avoid storing the output of every estimator by summing them here
-        if self.n_outputs_ > 1:
-            y_hat = np.zeros((X.shape[0], self.n_outputs_), dtype=np.float64)
-        else:
-            y_hat = np.zeros((X.shape[0]), dtype=np.float64)
+        y_hat = np.zeros(X.shape[0], dtype=np.float64)
 
-        # Parallel loop
-        lock = threading.Lock()
-        Parallel(n_jobs=n_jobs, verbose=self.verbose,
-                 **_joblib_parallel_args(require="sharedmem"))(
-            delayed(_accumulate_prediction_mod)(
-                e.predict, X, gene, [y_hat], lock)
-            for e, gene in zip(self.estimators_, mask))
+        # Each job owns a contiguous block of samples, so no lock is needed
+        def accumulate(rows):
+            y_hat[rows] = flat_forest.accumulate(X, trees, rows)[0]
 
-        n_trees = 0
-        for g in mask:
-            if g:
-                n_trees += 1
+        _map_row_chunks(accumulate, X.shape[0], _row_nbytes(X), self.n_jobs,
+                        row_cost=_FLAT_CELL_NBYTES * len(trees))
 
-        y_hat /= n_trees
+        y_hat /= len(trees)
 
         return y_hat
 
-    def oob_predict(self, X, y, genes, parallel=True):
+    def predict_buffer(self, X, parallel=True, encoding='dense', check_input=True):
+        """
+        Compute every tree's prediction for X and keep them in a
+        [n_samples, n_estimators] buffer so that chromosomes can be scored
+        with buffered_predict without running the trees again.
+
+        encoding : 'dense' keeps a float32 prediction per cell, 'leaf' keeps
+            the uint8 id of the leaf reached plus a per-tree table with the
+            leaf values, which takes a quarter of the memory.
+
+        check_input : as in predict.
+        """
+        check_is_fitted(self, 'estimators_')
+
+        if encoding not in ('dense', 'leaf'):
+            raise ValueError(f'Unknown buffer encoding: {encoding}')
+
+        if check_input:
+            X = self._validate_X_predict(X)
+
+        columns = self.__bufferize(X, None, encoding, parallel)
+
+        self.__predict_buffer = _build_buffer(
+            columns, None, X.shape[0], encoding)
+
+    def buffered_predict(self, ind):
+        """
+        Mean of the buffered predictions of the trees selected by ind.
+        """
+        return self.__predict_buffer.predict(_genes_to_mask(ind), n_jobs=self.n_jobs)
+
+    def buffered_predict_population(self, masks):
+        """
+        Score a whole population at once from the prediction buffer.
+
+        masks : [pop_size, n_estimators] 0/1 matrix, one chromosome per row.
+
+        Returns a [pop_size, n_samples] matrix with the prediction of each
+        chromosome, computed as a single matrix product.
+        """
+        return self.__predict_buffer.predict_population(_masks_to_matrix(masks), n_jobs=self.n_jobs)
+
+    def buffered_columns(self, trees):
+        """
+        Per sample float64 sum of the buffered predictions of the given trees
+        and int32 number of those predictions (len(trees) for the dense
+        encoding, where it never varies), so that running sums can be
+        updated a few trees at a time. The buffer is reduced in place, never copying
+        more than a cache sized block of the selected columns.
+        """
+        return self.__predict_buffer.columns(trees, n_jobs=self.n_jobs)
+
+    def get_predict_buffer(self):
+
+        return self.__predict_buffer.arrays
+
+    def set_predict_buffer(self, arrays):
+
+        self.__predict_buffer = self.__check_buffer(_buffer_from_arrays(arrays))
+
+    def oob_predict(self, X, y, genes, parallel=True, check_input=True):
         """
         Compute out-of-bag prediction.
+
+        check_input : as in predict.
         """
-        X = check_array(X, dtype=DTYPE, accept_sparse='csr')
+        if check_input:
+            X = check_array(X, dtype=DTYPE, accept_sparse='csr')
 
         n_samples = y.shape[0]
 
         predictions = np.zeros((n_samples, self.n_outputs_))
         n_predictions = np.zeros((n_samples, self.n_outputs_))
 
-        n_samples_bootstrap = _get_n_samples_bootstrap(
-            n_samples, None
-        )
-
         genes = [i == '1' or i == 1 for i in genes]
 
-        if parallel:
-            # Assign chunk of trees to jobs
-            n_jobs, _, _ = _partition_estimators(
-                self.n_estimators, self.n_jobs)
+        # Only the trees kept by the chromosome are traversed
+        trees = np.flatnonzero(genes)
+        bitmap = self.__oob_bitmap(n_samples)[trees]
+        flat_forest = self.__flat_forest()
 
-            # Parallel loop
-            lock = threading.Lock()
-            Parallel(n_jobs=n_jobs, verbose=self.verbose,
-                     **_joblib_parallel_args(require="sharedmem"))(
-                delayed(_oob_accumulate_prediction)(
-                    e.predict, X, gene, [predictions, n_predictions], lock, n_samples, n_samples_bootstrap, self.n_outputs_, e.random_state)
-                for e, gene in zip(self.estimators_, genes))
-        else:
-            for e, gene in zip(self.estimators_, genes):
-                if gene:
-                    unsampled_indices = _generate_unsampled_indices(
-                        e.random_state, n_samples, n_samples_bootstrap)
-                    p_estimator = e.predict(
-                        X[unsampled_indices, :], check_input=False)
-
-                    if self.n_outputs_ == 1:
-                        p_estimator = p_estimator[:, np.newaxis]
+        # Each job owns a contiguous block of samples, so no lock is needed
+        def accumulate(rows):
+            predictions[rows, 0], n_predictions[rows, 0] = flat_forest.accumulate(
+                X, trees, rows, _unpack_rows(bitmap, rows))
 
-                    predictions[unsampled_indices, :] += p_estimator
-                    n_predictions[unsampled_indices, :] += 1
-                else:
-                    pass
+        _map_row_chunks(accumulate, n_samples, _row_nbytes(X), self.n_jobs if parallel else 1,
+                        row_cost=_FLAT_CELL_NBYTES * len(trees))
 
         if (n_predictions == 0).any():
             warn("Some inputs do not have OOB scores. "
@@ -127,9 +181,24 @@ class Forest(RandomForestRegressor):
         predictions /= n_predictions
         return predictions
 
-    def oob_predict_buffer(self, X, y, parallel=True):
+    def oob_predict_buffer(self, X, y, parallel=True, encoding='sparse', check_input=True):
+        """
+        Compute and store the out-of-bag prediction of every tree.
 
-        X = check_array(X, dtype=DTYPE, accept_sparse='csr')
+        encoding : 'sparse' keeps only the OOB cells, in a
+            [n_samples, n_estimators] CSC matrix whose columns hold the
+            unsampled indices of a tree and its predictions for them, along
+            with the number of trees that left each sample out of bag.
+            'leaf' keeps a dense uint8 leaf id per cell, with a reserved id
+            for in-bag cells, plus a per-tree table with the leaf values.
+
+        check_input : as in predict.
+        """
+        if encoding not in ('sparse', 'leaf'):
+            raise ValueError(f'Unknown OOB buffer encoding: {encoding}')
+
+        if check_input:
+            X = check_array(X, dtype=DTYPE, accept_sparse='csr')
 
         n_samples = X.shape[0]
 
@@ -137,10 +206,86 @@ class Forest(RandomForestRegressor):
             n_samples, None
         )
 
-        prediction_buffer = np.zeros(
-            (n_samples_bootstrap, len(self.estimators_)), dtype='float32')
+        indices = [_unpack_unsampled_indices(bits, n_samples)
+                   for bits in self.__oob_bitmap(n_samples)]
+
+        columns = self.__bufferize(X, indices, encoding, parallel)
 
-        prediction_buffer[:, :] = np.nan
+        self.__buffer = _build_buffer(
+            columns, indices, n_samples_bootstrap, encoding)
+
+    def oob_buffered_predict(self, ind, n_slices=None):
+        """
+        Mean of the OOB predictions of the trees selected by ind. Samples
+        that none of those trees left out of bag get NaN.
+
+        n_slices : Number of row slices a leaf encoded buffer is reduced in.
+            By default it is chosen from the buffer shape and the cache size,
+            and slices are only spread over n_jobs threads when the buffer is
+            large. The sparse encoding is reduced in a single sparse product
+            and ignores it.
+        """
+        return self.__buffer.predict(
+            _genes_to_mask(ind), n_jobs=self.n_jobs, n_slices=n_slices)
+
+    def oob_buffered_predict_population(self, masks):
+        """
+        Score a whole population at once from the OOB buffer.
+
+        Returns a [pop_size, n_samples] matrix. Samples that none of the
+        selected trees left out of bag get NaN, as with oob_buffered_predict.
+        """
+        return self.__buffer.predict_population(_masks_to_matrix(masks), n_jobs=self.n_jobs)
+
+    def oob_buffered_columns(self, trees):
+        """
+        OOB counterpart of buffered_columns. In-bag cells add nothing to
+        either the sums or the counts.
+        """
+        return self.__buffer.columns(trees, n_jobs=self.n_jobs)
+
+    def get_oob_buffer(self):
+
+        return self.__buffer.arrays
+
+    def set_oob_buffer(self, arrays):
+
+        self.__buffer = self.__check_buffer(_buffer_from_arrays(arrays))
+
+    def __oob_bitmap(self, n_samples):
+        """
+        [n_estimators, ceil(n_samples / 8)] bit-packed OOB masks, computed
+        once and kept with the model. Forests pickled without it, or asked
+        about a different number of samples, build it on first use.
+        """
+        if getattr(self, 'oob_bitmap_', None) is None or self.oob_n_samples_ != n_samples:
+            n_samples_bootstrap = _get_n_samples_bootstrap(n_samples, None)
+            self.oob_bitmap_ = np.array([
+                np.packbits(np.bincount(
+                    _generate_sample_indices(e.random_state, n_samples, n_samples_bootstrap), minlength=n_samples) == 0)
+                for e in self.estimators_]).reshape(len(self.estimators_), -1)
+            self.oob_n_samples_ = n_samples
+
+        return self.oob_bitmap_
+
+    def __flat_forest(self):
+        """
+        Array backed copy of estimators_ used for every prediction, built on
+        first use after fit.
+        """
+        check_is_fitted(self, 'estimators_')
+
+        if getattr(self, 'flat_forest_', None) is None:
+            self.flat_forest_ = _FlatForest(self.estimators_)
+
+        return self.flat_forest_
+
+    def __bufferize(self, X, indices, encoding, parallel):
+
+        flat_forest = self.__flat_forest()
+
+        if indices is None:
+            indices = [None] * len(self.estimators_)
 
         if parallel:
             # Assign chunk of trees to jobs
@@ -148,82 +293,424 @@ class Forest(RandomForestRegressor):
                 self.n_estimators, self.n_jobs)
 
             # Parallel loop
-            lock = threading.Lock()
-            Parallel(n_jobs=n_jobs, verbose=self.verbose,
-                     **_joblib_parallel_args(require="sharedmem"))(
-                delayed(_oob_bufferize_prediction)(
-                    e.predict, X, estimator, prediction_buffer, lock, n_samples, n_samples_bootstrap, self.n_outputs_, e.random_state)
-                for e, estimator in zip(self.estimators_, range(0, len(self.estimators_))))
+            return Parallel(n_jobs=n_jobs, verbose=self.verbose,
+                            **_joblib_parallel_args(require="sharedmem"))(
+                delayed(_bufferize_prediction)(flat_forest, estimator, X, samples, encoding)
+                for estimator, samples in enumerate(indices))
         else:
-            for e, estimator in zip(self.estimators_, range(0, len(self.estimators_))):
-                unsampled_indices = _generate_unsampled_indices(
-                    e.random_state, n_samples, n_samples_bootstrap)
-                p_estimator = e.predict(X[unsampled_indices, :], check_input=False)
-                prediction_buffer[unsampled_indices, estimator] = p_estimator
+            return [_bufferize_prediction(flat_forest, estimator, X, samples, encoding)
+                    for estimator, samples in enumerate(indices)]
 
-        self.__buffer = prediction_buffer
+    def __check_buffer(self, buffer):
 
-    def oob_buffered_predict(self, n_slices, ind):
-        start = time.time()
-        genes = np.array(ind)
+        if buffer.shape[1] != len(self.estimators_):
+            raise ValueError(
+                f'Buffer has {buffer.shape[1]} columns but the forest has {len(self.estimators_)} trees')
 
-        estimators = genes == 1
+        return buffer
 
-        chunks = np.array_split(np.arange(0, len(self.__buffer)), n_slices)
 
-        res = Parallel(n_jobs=-1, verbose=5, require='sharedmem', max_nbytes=None)(delayed(np.nanmean)(self.__buffer[samples.min():samples.max()+1:, estimators], axis=1) for samples in chunks)
-        res = np.concatenate(res).ravel()
+class _FlatForest:
+    """
+    The leaves of every tree of a forest laid out in contiguous arrays,
+    indexed by node id plus the tree offset in roots, along with the
+    compiled trees that route samples to them.
 
-        print(f'{time.time()-start}')
+    Predictions for any subset of trees are computed block of samples by
+    block of samples, calling each tree's compiled apply directly, so there
+    is no per-tree input validation, estimator wrapper or joblib task.
+    """
 
-        return res
+    def __init__(self, estimators):
 
+        self.trees = [e.tree_ for e in estimators]
+        node_counts = [tree.node_count for tree in self.trees]
 
-def _oob_accumulate_prediction(predict, X, gene, out, lock, n_samples, n_samples_bootstrap, n_outputs_, random_state):
+        self.roots = np.zeros(len(self.trees) + 1, dtype=np.intp)
+        self.roots[1:] = np.cumsum(node_counts)
 
-    if gene:
-        unsampled_indices = _generate_unsampled_indices(
-            random_state, n_samples, n_samples_bootstrap)
-        p_estimator = predict(
-            X[unsampled_indices, :], check_input=False)
+        self.is_leaf = np.concatenate(
+            [tree.children_left == -1 for tree in self.trees])
+        self.value = np.concatenate(
+            [tree.value[:, 0, 0] for tree in self.trees])
 
-        if n_outputs_ == 1:
-            p_estimator = p_estimator[:, np.newaxis]
+    def apply(self, X, tree, rows=slice(None)):
+        """
+        Flat node ids of the leaves reached by X[rows] in the given tree.
+        X must already be validated, as a float32 array or csr_matrix.
+        """
+        return self.trees[tree].apply(X[rows]) + self.roots[tree]
 
-        with lock:
-            out[0][unsampled_indices, :] += p_estimator
-            out[1][unsampled_indices, :] += 1
-    else:
-        pass
+    def accumulate(self, X, trees, rows, oob=None):
+        """
+        Sum and count of the predictions of the given trees for the
+        contiguous slice of samples X[rows].
 
+        oob : optional [n_rows, n_trees] boolean mask, when given each tree
+            only predicts the rows it left out of bag.
+        """
+        # Sliced once for every tree, slicing a csr_matrix copies it
+        block = X[rows]
+
+        sums = np.zeros(block.shape[0], dtype=np.float64)
+        counts = np.zeros(block.shape[0], dtype=np.float64)
 
-def _oob_bufferize_prediction(predict, X, estimator, out, lock, n_samples, n_samples_bootstrap, n_outputs_, random_state):
+        for j, tree in enumerate(trees):
+            if oob is None:
+                sums += self.value[self.apply(block, tree)]
+                counts += 1
+            else:
+                selected = oob[:, j]
+                sums[selected] += self.value[self.apply(block, tree, selected)]
+                counts[selected] += 1
 
-    unsampled_indices = _generate_unsampled_indices(
-        random_state, n_samples, n_samples_bootstrap)
-    p_estimator = predict(
-        X[unsampled_indices, :], check_input=False)
+        return sums, counts
 
-    with lock:
-        out[unsampled_indices, estimator] = p_estimator
 
+# Rough bytes touched per (sample, tree) pair while routing through a tree
+_FLAT_CELL_NBYTES = 64
 
-def _accumulate_prediction_mod(predict, X, gene, out, lock):
-    """This is a utility function for joblib's Parallel.
 
-    It can't go locally in ForestClassifier or ForestRegressor, because joblib
-    complains that it cannot pickle it when placed there.
+class _DenseBuffer:
     """
-    if gene:
-        prediction = predict(X, check_input=False)
-        with lock:
-            if len(out) == 1:
-                out[0] += prediction
-            else:
-                for i in range(len(out)):
-                    out[i] += prediction[i]
+    Float32 [n_samples, n_estimators] matrix with every tree's prediction."""
+
+    def __init__(self, values):
+
+        self.values = values
+        self.shape = values.shape
+
+    @property
+    def arrays(self):
+
+        return {'values': self.values}
+
+    def predict(self, mask, n_jobs=None, n_slices=None):
+
+        weights = mask.astype(self.values.dtype)
+
+        return np.dot(self.values, weights) / np.sum(mask)
+
+    def predict_population(self, masks, n_jobs=None, n_slices=None):
+
+        weights = masks.astype(self.values.dtype)
+
+        scores = np.dot(weights, self.values.T)
+
+        return scores / np.sum(masks, axis=1)[:, np.newaxis]
+
+    def columns(self, trees, n_jobs=None):
+
+        sums = np.zeros(self.shape[0], dtype=np.float64)
+
+        # Only a cache sized block of the selected columns is copied at once
+        def reduce_rows(rows):
+            sums[rows] = self.values[rows][:, trees].sum(axis=1, dtype=np.float64)
+
+        _map_row_chunks(reduce_rows, self.shape[0], len(trees) * self.values.itemsize, n_jobs)
+
+        # Every tree predicts every sample
+        return sums, len(trees)
+
+
+class _SparseBuffer:
+    """
+    CSC [n_samples, n_estimators] matrix holding only the cells each tree
+    predicted, plus the number of trees that predicted each sample."""
+
+    def __init__(self, data, indices, indptr, counts):
+
+        self.shape = (len(counts), len(indptr) - 1)
+        self.matrix = csc_matrix((data, indices, indptr), shape=self.shape)
+        self.counts = counts
+
+    @property
+    def arrays(self):
+
+        return {'data': self.matrix.data, 'indices': self.matrix.indices,
+                'indptr': self.matrix.indptr, 'counts': self.counts}
+
+    def predict(self, mask, n_jobs=None, n_slices=None):
+
+        sums = self.matrix.dot(mask.astype(self.matrix.dtype))
+
+        # Counting over the smaller side of the mask and using the full
+        # forest count for the rest
+        if np.sum(mask) > len(mask) / 2:
+            counts = self.counts - self.__counts_of(~mask[np.newaxis, :])[0]
+        else:
+            counts = self.__counts_of(mask[np.newaxis, :])[0]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums / counts).astype(self.matrix.dtype)
+
+    def predict_population(self, masks, n_jobs=None, n_slices=None):
+
+        sums = self.matrix.dot(masks.T.astype(self.matrix.dtype)).T
+
+        counts = self.__counts_of(masks)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums / counts).astype(self.matrix.dtype)
+
+    def columns(self, trees, n_jobs=None):
+
+        sums = np.zeros(self.shape[0], dtype=np.float64)
+        counts = np.zeros(self.shape[0], dtype=np.int32)
+
+        indptr, indices, data = self.matrix.indptr, self.matrix.indices, self.matrix.data
+
+        # A column holds each of its samples once, so they can be added in place
+        for estimator in trees:
+            cells = slice(indptr[estimator], indptr[estimator + 1])
+            sums[indices[cells]] += data[cells]
+            counts[indices[cells]] += 1
+
+        return sums, counts
+
+    def __counts_of(self, masks):
+
+        counts = np.zeros((len(masks), self.shape[0]), dtype=np.int32)
+
+        indptr, indices = self.matrix.indptr, self.matrix.indices
+
+        for estimator in np.flatnonzero(np.any(masks, axis=0)):
+            counts[:, indices[indptr[estimator]:indptr[estimator + 1]]] += masks[:, estimator, np.newaxis]
+
+        return counts
+
+
+class _LeafBuffer:
+    """
+    Uint8 [n_samples, n_estimators] matrix with the leaf each sample reached
+    in each tree, and a [n_estimators, 256] table with the leaf values. The
+    id _NO_LEAF marks cells the tree did not predict (in-bag samples)."""
+
+    def __init__(self, leaves, values):
+
+        self.leaves = leaves
+        self.values = values
+        self.shape = leaves.shape
+
+    @property
+    def arrays(self):
+
+        return {'leaves': self.leaves, 'values': self.values}
+
+    def predict(self, mask, n_jobs=None, n_slices=None):
+
+        return self.predict_population(mask[np.newaxis, :], n_jobs, n_slices)[0]
+
+    def predict_population(self, masks, n_jobs=None, n_slices=None):
+
+        trees = np.flatnonzero(np.any(masks, axis=0))
+        weights = masks[:, trees].astype(self.values.dtype)
+
+        scores = np.zeros((len(masks), self.shape[0]), dtype=self.values.dtype)
+
+        def reduce_rows(rows):
+            values, counts = self.__gather(self.leaves[rows], trees)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                scores[:, rows] = np.dot(weights, values.T) / np.dot(weights, counts.T)
+
+        # Each gathered row holds a leaf id, a value and a count per tree
+        row_nbytes = len(trees) * (self.leaves.itemsize + 2 * self.values.itemsize)
+
+        _map_row_chunks(reduce_rows, self.shape[0], row_nbytes, n_jobs, n_slices)
+
+        return scores
+
+    def columns(self, trees, n_jobs=None):
+
+        trees = np.asarray(trees, dtype=np.intp)
+
+        sums = np.zeros(self.shape[0], dtype=np.float64)
+        counts = np.zeros(self.shape[0], dtype=np.int32)
+
+        def reduce_rows(rows):
+            values, predicted = self.__gather(self.leaves[rows], trees)
+            sums[rows] = values.sum(axis=1, dtype=np.float64)
+            counts[rows] = predicted.sum(axis=1, dtype=np.int32)
+
+        row_nbytes = len(trees) * (self.leaves.itemsize + 2 * self.values.itemsize)
+
+        _map_row_chunks(reduce_rows, self.shape[0], row_nbytes, n_jobs)
+
+        return sums, counts
+
+    def __gather(self, leaves, trees):
+
+        leaves = leaves[:, trees]
+
+        return self.values[trees, leaves], (leaves != _NO_LEAF).astype(self.values.dtype)
+
+
+_NO_LEAF = 255
+
+# Below this many bytes a reduction is not worth spreading over threads
+_PARALLEL_MIN_NBYTES = 1 << 24
+
+
+def _cache_size():
+    """
+    Size in bytes of the L2 cache, or 1MB when it cannot be found."""
+
+    try:
+        size = os.sysconf('SC_LEVEL2_CACHE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        size = 0
+
+    return size if size > 0 else 1 << 20
+
+
+def _map_row_chunks(func, n_rows, row_nbytes, n_jobs=None, n_slices=None, row_cost=None):
+    """
+    Calls func with contiguous row slices covering n_rows.
+
+    Slices are sized so the rows they touch fit in the L2 cache, or so that
+    there are n_slices of them if given. When the whole work, row_cost bytes
+    per row (row_nbytes by default), is larger than _PARALLEL_MIN_NBYTES the
+    rows are split into one contiguous block per thread, each walking its
+    block slice by slice, otherwise everything runs in the calling thread.
+    """
+    if n_slices:
+        chunk_rows = -(-n_rows // n_slices)
     else:
-        pass
+        chunk_rows = _cache_size() // max(row_nbytes, 1)
+    chunk_rows = max(chunk_rows, 1)
+
+    n_jobs = min(effective_n_jobs(n_jobs), -(-n_rows // chunk_rows))
+    if n_rows * (row_cost or row_nbytes) < _PARALLEL_MIN_NBYTES:
+        n_jobs = 1
+
+    def walk(block):
+        for start in range(block.start, block.stop, chunk_rows):
+            func(slice(start, min(start + chunk_rows, block.stop)))
+
+    if n_jobs <= 1:
+        walk(slice(0, n_rows))
+        return
+
+    block_rows = -(-n_rows // n_jobs)
+    Parallel(n_jobs=n_jobs, require='sharedmem')(
+        delayed(walk)(slice(start, min(start + block_rows, n_rows)))
+        for start in range(0, n_rows, block_rows))
+
+
+def _bufferize_prediction(flat_forest, estimator, X, indices, encoding):
+
+    nodes = flat_forest.apply(
+        X, estimator, slice(None) if indices is None else indices)
+
+    if encoding == 'leaf':
+        # Leaf ids are numbered inside each tree, in node order
+        tree_nodes = slice(flat_forest.roots[estimator], flat_forest.roots[estimator + 1])
+        leaves = np.flatnonzero(flat_forest.is_leaf[tree_nodes])
+
+        if len(leaves) > _NO_LEAF:
+            raise ValueError(
+                f'Leaf encoding supports up to {_NO_LEAF} leaves per tree, got {len(leaves)}')
+
+        leaf_ids = np.full(tree_nodes.stop - tree_nodes.start, _NO_LEAF, dtype=np.uint8)
+        leaf_ids[leaves] = np.arange(len(leaves))
+
+        values = np.zeros(_NO_LEAF + 1, dtype='float32')
+        values[:len(leaves)] = flat_forest.value[tree_nodes][leaves]
+
+        return leaf_ids[nodes - tree_nodes.start], values
+
+    return flat_forest.value[nodes].astype('float32'), None
+
+
+def _build_buffer(columns, indices, n_samples, encoding):
+    """
+    Assemble the per-tree output of _bufferize_prediction into a buffer."""
+
+    if indices is None:
+        indices = [slice(None)] * len(columns)
+
+    if encoding == 'leaf':
+        leaves = np.full((n_samples, len(columns)), _NO_LEAF, dtype=np.uint8)
+        for estimator, (samples, (column, _)) in enumerate(zip(indices, columns)):
+            leaves[samples, estimator] = column
+        return _LeafBuffer(leaves, np.array([values for _, values in columns]))
+
+    if encoding == 'sparse':
+        indptr = np.zeros(len(columns) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(samples) for samples in indices])
+        samples = np.concatenate(indices).astype(np.int32)
+        data = np.concatenate([column for column, _ in columns])
+        return _SparseBuffer(data, samples, indptr, np.bincount(samples, minlength=n_samples))
+
+    values = np.zeros((n_samples, len(columns)), dtype='float32')
+    for estimator, (samples, (column, _)) in enumerate(zip(indices, columns)):
+        values[samples, estimator] = column
+    return _DenseBuffer(values)
+
+
+def _buffer_from_arrays(arrays):
+    """
+    Rebuild a buffer from the arrays exposed by its arrays property."""
+
+    if isinstance(arrays, np.ndarray):
+        return _DenseBuffer(arrays)
+
+    names = set(arrays)
+
+    if names == {'leaves', 'values'}:
+        return _LeafBuffer(arrays['leaves'], arrays['values'])
+
+    if names == {'data', 'indices', 'indptr', 'counts'}:
+        return _SparseBuffer(arrays['data'], arrays['indices'], arrays['indptr'], arrays['counts'])
+
+    if names == {'values'}:
+        return _DenseBuffer(arrays['values'])
+
+    # e.g. a folder left incomplete by an interrupted save
+    raise ValueError(f'Incomplete or unknown buffer arrays: {sorted(names)}')
+
+
+def _unpack_unsampled_indices(bits, n_samples):
+    """
+    Unsampled indices of a tree from its row of the packed OOB bitmap."""
+
+    return np.flatnonzero(np.unpackbits(bits, count=n_samples))
+
+
+def _row_nbytes(X):
+    """
+    Bytes taken by one row of X, estimated from the stored values when it is
+    sparse."""
+
+    if issparse(X):
+        return max(X.data.nbytes + X.indices.nbytes, 1) // max(X.shape[0], 1)
+
+    return X.shape[1] * X.itemsize
+
+
+def _unpack_rows(bitmap, rows):
+    """
+    [n_rows, n_trees] boolean OOB mask for a slice of samples, unpacked
+    from a [n_trees, ceil(n_samples / 8)] packed bitmap."""
+
+    offset = rows.start % 8
+    bits = np.unpackbits(bitmap[:, rows.start // 8:(rows.stop + 7) // 8], axis=1)
+
+    return bits[:, offset:offset + rows.stop - rows.start].T.astype(bool)
+
+
+def _genes_to_mask(genes):
+    """
+    Boolean tree mask from a chromosome given as 0/1 ints or '0'/'1' chars."""
+
+    return np.array([g == '1' or g == 1 for g in genes], dtype=bool)
+
+
+def _masks_to_matrix(masks):
+    """
+    Boolean [pop_size, n_estimators] matrix from a list of chromosomes."""
+
+    return np.array([_genes_to_mask(genes) for genes in masks], dtype=bool).reshape(len(masks), -1)
 
 
 def _get_n_samples_bootstrap(n_samples, max_samples):
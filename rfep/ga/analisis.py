@@ -1,10 +1,11 @@
 from pathlib import Path
-from .misc import DatasetHandler
+from .misc import DatasetHandler, metric_summary
 from .evaluation import Evaluator
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 import json
+from functools import partial
 from rpy2 import robjects
 
 
@@ -33,17 +34,21 @@ class Analyst():
 
         self.__load_model(fold)
 
+        # Final scoring goes through the same forest inference as the evolution
+        self.__evaluator.set_predict_method(
+            partial(self.__model.predict, self.__dataset_handler.X, check_input=False))
+
         self.__population_bank = self.__dict_persist.load(
             f'Fold{fold}/population_bank')
 
-        if len(self.__evaluator.metrics) == 2:
+        if len(self.__evaluator.metrics) > 1:
             pareto_front = self.__dict_persist.load(f'Fold{fold}/pareto_front')
             best = 0
             for i, ind in enumerate(pareto_front):
                 if i == 0:
                     best = i
                 else:
-                    if np.mean(self.__population_bank[pareto_front[best]]['ndcg']) < np.mean(self.__population_bank[ind]['ndcg']):
+                    if metric_summary(self.__population_bank[pareto_front[best]][self.__objectives[0]])[0] < metric_summary(self.__population_bank[ind][self.__objectives[0]])[0]:
                         best = i
             self.__best = pareto_front[best]
         else:
@@ -55,13 +60,15 @@ class Analyst():
 
         for ind, fitness in zip(['initial', 'final'], evaluations):
             report[ind] = {}
-            for fit, value in zip(['ndcg', 'georisk'], fitness):
+            for fit, value in zip(self.__objectives, fitness):
                 report[ind][fit] = value.tolist()
 
         report['initial']['n_trees'] = len(self.__best)
         report['final']['n_trees'] = self.__best.count('1')
-        report['initial']['ndcg_mean'] = np.mean(report['initial']['ndcg'])
-        report['final']['ndcg_mean'] = np.mean(report['final']['ndcg'])
+        for fit in self.__objectives:
+            if fit != 'georisk':
+                report['initial'][f'{fit}_mean'] = np.mean(report['initial'][fit])
+                report['final'][f'{fit}_mean'] = np.mean(report['final'][fit])
 
         self.__dict_persist.save(report, f'Fold{fold}/fold_comparison')
 
@@ -78,13 +85,10 @@ class Analyst():
                 matrix.append([float(line.rstrip('\n')) for line in file])
                 file.close()
 
-        new_matrix = np.zeros((len(matrix) + 2, len(matrix[0])))
-
-        for i in range(len(matrix)):
-            new_matrix[i, :] = np.array(matrix[i])
+        self.__evaluator.set_baselines(np.array(matrix))
 
         evaluations = self.__evaluator.evaluate_compare(
-            ['1'*len(self.__best), self.__best], new_matrix)
+            ['1'*len(self.__best), self.__best])
 
         return evaluations
 
@@ -100,16 +104,14 @@ class Analyst():
             for n_gen, generation in archive_bank.items():
                 if len(generation) == 0:
                     continue
-                maximum.append(
-                    np.max([np.mean(population_bank[ind][metric]) for ind in generation]))
-                mean.append(np.mean([np.mean(population_bank[ind][metric])
-                                     for ind in generation]))
-                minimum.append(
-                    np.min([np.mean(population_bank[ind][metric]) for ind in generation]))
-                std.append(np.std([np.std(population_bank[ind][metric])
-                                   for ind in generation]))
-                var.append(np.var([np.mean(population_bank[ind][metric])
-                                   for ind in generation]))
+                # Entries evicted from the bank only keep their mean and std
+                means, stds = zip(*[metric_summary(population_bank[ind][metric])
+                                    for ind in generation])
+                maximum.append(np.max(means))
+                mean.append(np.mean(means))
+                minimum.append(np.min(means))
+                std.append(np.std(stds))
+                var.append(np.var(means))
 
             gens = range(0, len(maximum))
 
@@ -168,6 +170,7 @@ class Analyst():
             test = DatasetHandler(
                 f'data/dataset/{self.__dataset_name}/Fold{fold}/Norm.test.txt')
             test.load()
+            self.__dataset_handler = test
             self.__evaluator = Evaluator(self.__objectives, self.__weights,
                                          self.__dataset_name, test.X, test.y, test.query_id)
             comparisons.append(self.__process_fold(fold))
@@ -183,35 +186,34 @@ class Analyst():
                 folds.append(json.load(file))
                 file.close()
 
-        ndcg = {'initial': [], 'final': []}
-        georisk = {'initial': [], 'final': []}
+        objectives = {fit: {'initial': [], 'final': []} for fit in self.__objectives}
         n_trees = {'initial': [], 'final': []}
 
         for fold in folds:
             for ind in ['initial', 'final']:
-                ndcg[ind].append(fold[ind]['ndcg'])
-                georisk[ind].append(fold[ind]['georisk'])
+                for fit in self.__objectives:
+                    objectives[fit][ind].append(fold[ind][fit])
                 n_trees[ind].append(fold[ind]['n_trees'])
 
-        for ind in ['initial', 'final']:
-            ndcg[ind] = np.array(ndcg[ind]).flatten()
-
         comparison = {}
 
-        comparison['ndcg_equal'] = compare(ndcg['initial'], ndcg['final'])
+        for fit, values in objectives.items():
+            for ind in ['initial', 'final']:
+                values[ind] = np.array(values[ind]).flatten()
+
+            # Per query metrics are compared query by query over every fold,
+            # georisk is a single value per fold
+            if fit != 'georisk':
+                comparison[f'{fit}_equal'] = compare(
+                    values['initial'], values['final'])
 
-        # comparison['georisk_equal'] = compare(
-        #    georisk['initial'], georisk['final'])
+            for ind in ['initial', 'final']:
+                values[ind] = np.mean(values[ind])
+            comparison[fit] = values
 
-        ndcg['initial'] = np.mean(ndcg['initial'])
-        ndcg['final'] = np.mean(ndcg['final'])
-        georisk['initial'] = np.mean(georisk['initial'])
-        georisk['final'] = np.mean(georisk['final'])
-        n_trees['initial'] = np.mean(n_trees['initial'])
-        n_trees['final'] = np.mean(n_trees['final'])
+        for ind in ['initial', 'final']:
+            n_trees[ind] = np.mean(n_trees[ind])
 
-        comparison['ndcg'] = ndcg
-        comparison['georisk'] = georisk
         comparison['n_trees'] = n_trees
 
         self.__dict_persist.save(comparison, 'final_report')
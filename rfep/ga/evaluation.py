@@ -1,12 +1,21 @@
-from ..l2r.l2rCodes import getEvaluation, getGeoRisk, getQueries
+from ..l2r.l2rCodes import getGeoRisk, geoRiskFromTotals, getDatasetType, getQueryOffsets, getQueryBlocks, getIdealDcg, getMetricsQueries, parseMetric
 import numpy as np
 import multiprocessing as mp
-from .misc import _chromosome_to_key
+from joblib import Parallel, delayed, effective_n_jobs, parallel_backend
+from collections import OrderedDict
+from .misc import _chromosome_to_packed
 import time
 
+# Upper bound of the temporaries of a batch of individuals scored at once:
+# buffer sums, counts and the float64 scores of each (individual, sample)
+_SCORE_BATCH_NBYTES = 1 << 27
+_SCORE_CELL_NBYTES = 16
+# Memory given to the running sums kept for delta scoring
+_DELTA_CACHE_NBYTES = 1 << 28
+
 class Evaluator:
 
-    def __init__(self, metrics, weights, dataset_name, __X_dataset, __y_dataset, __queries_dataset, _oob=False, parallel=True):
+    def __init__(self, metrics, weights, dataset_name, __X_dataset, __y_dataset, __queries_dataset, _oob=False, parallel=True, n_jobs=None):
 
         self.metrics = metrics
         self.weights = weights
@@ -16,97 +25,295 @@ class Evaluator:
         self.__queries_dataset = __queries_dataset
         self._oob = _oob
         self.parallel = parallel
+        self.n_jobs = n_jobs
         self.__predict_method = None
+        self.__population_predict_method = None
+        self.__columns_method = None
+        self.__states = OrderedDict()
+        self.__states_nbytes = 0
+        self.__baseline_Tj = 0
+
+        self.__validate_metrics()
+
+        # Per query metrics are computed from a single ranking, georisk is
+        # computed over the first of them
+        self.__query_metrics = [
+            metric for metric in self.metrics if metric != 'georisk']
+        self.__risk_metric = self.__query_metrics[0]
+
+        # The query layout, labels and ideal DCG of the evaluation set never
+        # change, so each evaluation only has to rank the scores
+        self.__dataset_type = getDatasetType(self.dataset_name)
+        self.__query_offsets = getQueryOffsets(self.__queries_dataset)
+        self.__query_blocks = getQueryBlocks(self.__query_offsets)
+        self.__labels = np.asarray(self.__y_dataset).astype(int)
+        self.__ideal_dcg = {}
+        for name, k in map(parseMetric, self.__query_metrics):
+            if name == 'ndcg' and k not in self.__ideal_dcg:
+                self.__ideal_dcg[k] = getIdealDcg(
+                    self.__query_offsets, self.__labels, self.__dataset_type, k, self.__query_blocks)
+        self.__n_queries = len(self.__query_offsets) - 1
 
-        try:
-            self.__validate_metrics()
-        except Exception as e:
-            print(e)
+    def __validate_metrics(self):
 
-        self.__n_queries = getQueries(self.__queries_dataset)
+        if not isinstance(self.metrics, list) or not isinstance(self.weights, list) \
+                or len(self.metrics) != len(self.weights):
+            raise ValueError(
+                'Weights must be a list of int or float with same lenght as metrics')
 
-    def __validate_metrics(self):
+        for w in self.weights:
+            if not isinstance(w, (int, float)):
+                raise ValueError('Weights must be a list of int or float')
 
-        if f'__evaluate_{self.metrics}' in dir(self):
-            if isinstance(self.metrics, list) and len(self.metrics) == len(self.weights):
-                for w in self.weights:
-                    if isinstance(w, int) or isinstance(w, float):
-                        return True
-                    else:
-                        raise ValueError(
-                            'Weights must be a list of int or float')
-            else:
-                ValueError(
-                    'Weights must be a list of int or float with same lenght as metrics')
-        else:
-            ValueError('The specified metrics cannot be evaluated')
+        for metric in self.metrics:
+            if metric != 'georisk':
+                parseMetric(metric)
+
+        if all(metric == 'georisk' for metric in self.metrics):
+            raise ValueError(
+                'georisk needs a per query metric such as ndcg, map or err')
+
+        return True
 
     def set_predict_method(self, method):
 
         self.__predict_method = method
 
+    def set_population_predict_method(self, method):
+
+        self.__population_predict_method = method
+
+    def set_columns_method(self, method, cache_nbytes=_DELTA_CACHE_NBYTES):
+        """
+        Enables delta scoring: method(trees) must return, per sample, the sum
+        of the buffered values of those trees and how many of them predicted
+        it, or just len(trees) when all of them predict every sample. The
+        running sums of the last evaluated individuals are kept within
+        cache_nbytes, and a new individual is scored from the closest of
+        them by only adding and removing the trees that differ. The running
+        sums are kept in this process, so with n_jobs the workers score from
+        scratch.
+        """
+        self.__columns_method = method
+        self.__states = OrderedDict()
+        self.__states_nbytes = cache_nbytes
+
     def __get_scores(self, ind):
 
         return self.__predict_method(ind)
 
-    def __evaluate_ndcg(self, scores):
+    def __get_scores_population(self, inds):
+
+        if self.__columns_method:
+            return [self.__get_scores_delta(ind) for ind in inds]
+
+        if self.__population_predict_method and len(inds) > 0:
+            return self.__population_predict_method(inds)
+
+        return [self.__get_scores(ind) for ind in inds]
+
+    def __get_scores_delta(self, ind):
+
+        mask = np.array([g == '1' or g == 1 for g in ind], dtype=bool)
+
+        parent = self.__nearest_state(mask)
+
+        if parent is None:
+            sums, counts = self.__sum_columns(np.flatnonzero(mask))
+        else:
+            parent_mask, parent_sums, parent_counts = parent
+            added_sums, added_counts = self.__sum_columns(
+                np.flatnonzero(mask & ~parent_mask))
+            removed_sums, removed_counts = self.__sum_columns(
+                np.flatnonzero(parent_mask & ~mask))
+            sums = parent_sums + added_sums - removed_sums
+            counts = np.subtract(np.add(parent_counts, added_counts, dtype=np.int32),
+                                 removed_counts, dtype=np.int32)
+
+        # Counts only vary between samples with OOB buffers, and then fit in
+        # the smallest integer able to hold the number of trees
+        if np.ndim(counts) == 0:
+            counts = int(counts)
+        else:
+            counts = counts.astype(np.min_scalar_type(len(mask)))
+
+        key = _chromosome_to_packed(ind)
+        self.__states[key] = (mask, sums, counts)
+        self.__states.move_to_end(key)
+        state_nbytes = mask.nbytes + sums.nbytes + np.asarray(counts).nbytes
+        while len(self.__states) > max(1, self.__states_nbytes // state_nbytes):
+            self.__states.popitem(last=False)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return sums / counts
+
+    def __nearest_state(self, mask):
+
+        if len(self.__states) == 0:
+            return None
+
+        states = list(self.__states.values())
+        distances = np.sum(
+            np.array([state[0] for state in states]) != mask, axis=1)
+        nearest = np.argmin(distances)
 
-        return getEvaluation(
-            scores, self.__queries_dataset, self.__y_dataset, self.dataset_name, 'ndcg')[1]
+        # Starting from scratch is cheaper when the closest parent is too far
+        if distances[nearest] >= np.sum(mask):
+            return None
+
+        return states[nearest]
+
+    def __sum_columns(self, trees):
+
+        sums, counts = self.__columns_method(trees)
+
+        if np.ndim(counts) and np.all(counts == len(trees)):
+            counts = len(trees)
+
+        return sums, counts
+
+    def __evaluate_queries(self, scores):
+
+        return getMetricsQueries(
+            np.asarray(scores).reshape(len(scores), -1), self.__query_offsets, self.__labels,
+            self.__dataset_type, self.__query_metrics, self.__query_blocks, self.__ideal_dcg)
+
+    def __evaluate_unique(self, inds):
+        """
+        Per query metrics of inds, scored in batches whose temporaries stay
+        under _SCORE_BATCH_NBYTES. With n_jobs the individuals are split in
+        one contiguous chunk per worker process, each scoring and ranking its
+        chunk. Buffers and datasets memory mapped from storage reach the
+        workers as a reference to their file, and joblib memory maps the
+        other large arrays once per call, so nothing big is pickled.
+        """
+        n_jobs = min(effective_n_jobs(self.n_jobs), len(inds)) if self.n_jobs else 1
+
+        if n_jobs <= 1:
+            return _evaluate_batches(inds, self.__query_offsets[-1],
+                                     self.__get_scores_population, self.__evaluate_queries)
+
+        chunk = -(-len(inds) // n_jobs)
+        results = Parallel(n_jobs=n_jobs, backend='loky')(
+            delayed(_evaluate_chunk)(
+                self.__predict_method, self.__population_predict_method, inds[start:start + chunk],
+                self.__query_offsets, self.__labels, self.__dataset_type, self.__query_metrics,
+                self.__query_blocks, self.__ideal_dcg)
+            for start in range(0, len(inds), chunk))
+
+        return {metric: np.concatenate([result[metric] for result in results])
+                for metric in self.__query_metrics}
 
     def __evaluate_georisk(self, matrix, alpha=5):
 
         return getGeoRisk(matrix, alpha)
 
     def evaluate(self, population, bank=None):
+        """
+        Evaluates population. Individuals cached in bank, a FitnessBank, are
+        not scored again. GeoRisk is computed over the population matrix.
+        """
 
-        evaluations = []
+        evaluations = {metric: np.zeros((len(population), self.__n_queries))
+                       for metric in self.__query_metrics}
 
-        if 'ndcg' in self.metrics:
+        missing = []
 
-            ndcg = np.zeros((len(population), len(self.__n_queries)))
+        for i in range(0, len(population)):
+            cached = bank.get(population[i], self.__query_metrics) if bank is not None else None
+            if cached is not None:
+                for metric in self.__query_metrics:
+                    evaluations[metric][i, :] = cached[metric]
+            else:
+                missing.append(i)
+
+        if missing:
+            # Identical individuals, common after selection and cloning, are
+            # scored once and their values copied to every occurrence
+            positions = {}
+            unique = []
+            inverse = []
+            for i in missing:
+                key = _chromosome_to_packed(population[i])
+                if key not in positions:
+                    positions[key] = len(unique)
+                    unique.append(i)
+                inverse.append(positions[key])
+
+            computed = self.__evaluate_unique([list(population[i]) for i in unique])
+            for metric in self.__query_metrics:
+                evaluations[metric][missing, :] = computed[metric][inverse]
+
+        if 'georisk' in self.metrics:
+            georisk = self.__evaluate_georisk(
+                np.transpose(evaluations[self.__risk_metric]))
+            evaluations['georisk'] = georisk
+
+            if bank is not None:
+                for i, ind in enumerate(population):
+                    bank.set_scalar(ind, 'georisk', georisk[i])
 
-            for i in range(0, len(population)):
-                if bank and _chromosome_to_key(population[i]) in bank:
-                    ndcg[i, :] = np.array(
-                        bank[_chromosome_to_key(population[i])]['ndcg'])
-                else:
-                    scores = self.__get_scores(list(population[i]))
-                    ndcg[i, :] = self.__evaluate_ndcg(scores)
+        return zip(*[evaluations[metric] for metric in self.metrics])
 
-            evaluations.append(ndcg)
+    def set_baselines(self, baselines):
+        """
+        Caches the query totals of the baselines, a [n_baselines, n_queries]
+        matrix with their values of the first per query metric, against
+        which evaluate_compare computes georisk.
+        """
+        self.__baseline_Tj = np.sum(np.asarray(baselines, dtype=float), axis=0)
 
-        if 'georisk' in self.metrics and 'ndcg' in self.metrics:
-            georisk = self.__evaluate_georisk(np.transpose(ndcg))
-            evaluations.append(georisk)
+    def evaluate_compare(self, inds):
+        """
+        Evaluates inds against the baselines given to set_baselines. Each
+        call only adds the query totals of inds to the cached ones, so the
+        georisk of an individual costs O(n_queries).
+        """
+        evaluations = self.__evaluate_queries(
+            self.__get_scores_population(inds))
 
-            for i, ind in enumerate(population):
-                if bank and _chromosome_to_key(ind) in bank:
-                    bank[_chromosome_to_key(ind)]['georisk'] = georisk[i]
+        if 'georisk' in self.metrics:
+            candidates = evaluations[self.__risk_metric]
+            Tj = self.__baseline_Tj + np.sum(candidates, axis=0)
+            evaluations['georisk'] = geoRiskFromTotals(
+                np.transpose(candidates), Tj, np.sum(Tj), 5)
 
-        return zip(*evaluations)
+        return zip(*[evaluations[metric] for metric in self.metrics])
 
-    def evaluate_compare(self, inds, matrix):
 
-        evaluations = []
+def _evaluate_chunk(predict, population_predict, inds, offsets, labels, dataset_type, metrics, blocks, ideal_dcg):
 
-        ndcgs = []
+    def score(batch):
+        if population_predict:
+            return population_predict(batch)
+        return [predict(ind) for ind in batch]
 
-        for i, ind in enumerate(inds):
-            ndcg = self.__evaluate_ndcg(self.__get_scores(ind))
-            ndcgs.append(ndcg)
-            matrix[i-2, :] = ndcg[:]
+    def evaluate(scores):
+        return getMetricsQueries(
+            np.asarray(scores).reshape(len(scores), -1), offsets, labels,
+            dataset_type, metrics, blocks, ideal_dcg)
 
-        georisk = self.__evaluate_georisk(matrix.transpose())
-        evaluations.append(georisk[-2:])
+    # Each worker already owns a core, so the forest does not spawn threads
+    with parallel_backend('sequential'):
+        return _evaluate_batches(inds, offsets[-1], score, evaluate)
 
-        return zip(ndcgs, *evaluations)
+
+def _evaluate_batches(inds, n_samples, score, evaluate):
+
+    batch = max(1, _SCORE_BATCH_NBYTES // (max(n_samples, 1) * _SCORE_CELL_NBYTES))
+
+    results = [evaluate(score(inds[start:start + batch]))
+               for start in range(0, len(inds), batch)]
+
+    return {metric: np.concatenate([result[metric] for result in results])
+            for metric in results[0]}
 
 
 def _eval_ind(e_function, ind, bank, model):
 
-    if bank and _chromosome_to_key(ind) in bank:
-        return np.array(
-            bank[_chromosome_to_key(ind)]['ndcg'])
+    cached = bank.get(ind, ['ndcg']) if bank is not None else None
+
+    if cached is not None:
+        return np.array(cached['ndcg'])
     else:
         return e_function(ind, model.oob_buffered_predict)
\ No newline at end of file
@@ -3,7 +3,12 @@ from abc import ABC
 import pickle
 import dill
 import json
-from ..l2r.l2rCodes import load_L2R_file
+import hashlib
+import shutil
+from collections import OrderedDict
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+from ..l2r.l2rCodes import load_L2R_file, getQueryOffsets
 
 
 class Persist(ABC):
@@ -65,6 +70,43 @@ class ModelPersist(Persist):
             raise ValueError(f'Unable to load from {path}')
 
 
+    def save_buffer(self, arrays, filename, create_if_not_exists=True):
+        """
+        Saves the arrays of a forest buffer, as given by get_predict_buffer,
+        as .npy files inside a folder named after filename. The folder is
+        written aside and renamed, so it is either complete or absent.
+        """
+        path = self.path / filename
+        temporary = self.path / (filename + '.tmp')
+
+        if isinstance(arrays, np.ndarray):
+            arrays = {'values': arrays}
+
+        if self._check_path(create_if_not_exists):
+            try:
+                shutil.rmtree(temporary, ignore_errors=True)
+                temporary.mkdir(parents=True)
+                for name, array in arrays.items():
+                    np.save(temporary / (name + '.npy'), array)
+                shutil.rmtree(path, ignore_errors=True)
+                temporary.rename(path)
+            except IOError:
+                raise IOError('Unable to save')
+
+    def load_buffer(self, filename, mmap_mode='r'):
+        """
+        Loads the arrays saved by save_buffer. By default they are memory
+        mapped, so the buffer is read lazily from the page cache and shared
+        by every process that opens it instead of being copied in memory.
+        """
+        path = self.path / filename
+
+        if path.is_dir():
+            return {array.stem: np.load(array, mmap_mode=mmap_mode) for array in path.glob('*.npy')}
+        else:
+            raise ValueError(f'Unable to load from {path}')
+
+
 class DictPersist(Persist):
 
     def __init__(self, path, ext='.json'):
@@ -97,15 +139,284 @@ class DictPersist(Persist):
 
 class DatasetHandler:
 
-    def __init__(self, path):
+    def __init__(self, path, cache=True, cache_path=None, csr=False):
 
         self.__path = path
+        self.__cache = cache
+        self.__csr = csr
+        self.__cache_path = Path(cache_path) if cache_path else Path(path).parent / '.cache'
         self.X = None
         self.y = None
         self.query_id = None
+        self.query_offsets = None
 
     def load(self):
-        self.X, self.y, self.query_id = load_L2R_file(self.__path, False)
+        """
+        Loads the dataset. With cache, the parsed arrays are saved as .npy
+        files keyed by the file path, size and modification time, and later
+        loads memory map them instead of parsing the text file again. When
+        the cache cannot be written the parsed arrays are used as is. With
+        csr, X is a scipy.sparse.csr_matrix of the nonzero features.
+
+        X is always float32 and C-contiguous (or CSR with 32 bit indices),
+        the representation the forest works on, so it can be passed to the
+        Forest methods with check_input=False.
+        """
+        if not self.__cache:
+            self.__parse()
+            self.X = _as_forest_input(self.X)
+            return
+
+        source = Path(self.__path)
+        stat = source.stat()
+        # Files of the same name (e.g. the train file of every fold) can share
+        # a cache folder, so the key starts with the name and its full path
+        prefix = f'{source.name}.{hashlib.sha1(str(source.resolve()).encode()).hexdigest()[:12]}'
+        key = f'{prefix}.{stat.st_size}.{stat.st_mtime_ns}' + ('.csr' if self.__csr else '')
+        persist = ModelPersist(self.__cache_path)
+
+        try:
+            arrays = persist.load_buffer(key)
+            if set(arrays) != set(_dataset_array_names(self.__csr)):
+                raise ValueError(f'Incomplete cache {key}')
+        except ValueError:
+            self.__parse()
+            try:
+                self.__save_cache(persist, key, prefix)
+                arrays = persist.load_buffer(key)
+            except OSError:
+                # e.g. a read-only data mount, the parsed arrays are kept
+                self.X = _as_forest_input(self.X)
+                return
+
+        self.X, self.y, self.query_id, self.query_offsets = _dataset_from_arrays(
+            arrays)
+        self.X = _as_forest_input(self.X)
+
+    def __parse(self):
+
+        self.X, self.y, self.query_id = load_L2R_file(
+            self.__path, False, csr=self.__csr)
+        self.query_offsets = getQueryOffsets(self.query_id)
+
+    def __save_cache(self, persist, key, prefix):
+
+        persist.save_buffer(_dataset_to_arrays(
+            self.X, self.y, self.query_id, self.query_offsets), key)
+
+        # Caches of older versions of the same file
+        for stale in self.__cache_path.glob(f'{prefix}.*.*'):
+            if stale.name != key and stale.name.count('.') == key.count('.') and stale.is_dir():
+                shutil.rmtree(stale, ignore_errors=True)
+
+
+def _as_forest_input(X):
+
+    if issparse(X):
+        X = csr_matrix(X, dtype=np.float32, copy=False)
+        if (X.indices.dtype != np.intc or X.indptr.dtype != np.intc) and X.nnz < np.iinfo(np.intc).max:
+            X.indices = X.indices.astype(np.intc)
+            X.indptr = X.indptr.astype(np.intc)
+        return X
+
+    return np.ascontiguousarray(X, dtype=np.float32)
+
+
+def _dataset_array_names(csr):
+
+    return ('X_data', 'X_indices', 'X_indptr', 'X_shape') * csr + ('X',) * (not csr) + \
+        ('y', 'query_id', 'query_offsets')
+
+
+def _dataset_to_arrays(X, y, query_id, query_offsets):
+
+    arrays = {'y': y, 'query_id': query_id, 'query_offsets': query_offsets}
+
+    if issparse(X):
+        arrays.update(X_data=X.data, X_indices=X.indices,
+                      X_indptr=X.indptr, X_shape=np.array(X.shape))
+    else:
+        arrays['X'] = X
+
+    return arrays
+
+
+def _dataset_from_arrays(arrays):
+
+    if 'X_indptr' in arrays:
+        X = csr_matrix((arrays['X_data'], arrays['X_indices'], arrays['X_indptr']),
+                       shape=tuple(arrays['X_shape']), copy=False)
+    else:
+        X = arrays['X']
+
+    return X, arrays['y'], arrays['query_id'], arrays['query_offsets']
+
+
+class FitnessBank:
+    """
+    Fitness of the evaluated chromosomes, keyed by their bit-packed genes.
+    Per query vectors live in one preallocated array per metric and scalar
+    values (georisk, generated) next to them. With max_size, the least
+    recently used chromosomes beyond it are evicted, keeping only the mean
+    and std of their vectors; they are not served as cached fitness anymore
+    but are still exported by to_dict.
+    """
+
+    def __init__(self, max_size=None):
+
+        self.max_size = max_size
+        self.__slots = OrderedDict()
+        self.__free = []
+        self.__vectors = {}
+        self.__scalars = {}
+        self.__held = {}
+        self.__evicted = {}
+        self.__n_genes = None
+
+    def __len__(self):
+
+        return len(self.__slots)
+
+    def __contains__(self, chromosome):
+
+        return _chromosome_to_packed(chromosome) in self.__slots
+
+    def get(self, chromosome, metrics):
+        """
+        Vectors and scalars of metrics for chromosome, or None when it is
+        not cached or lacks any of them.
+        """
+        key = _chromosome_to_packed(chromosome)
+
+        if key not in self.__slots:
+            return None
+
+        slot = self.__slots[key]
+        values = {}
+        for metric in metrics:
+            if metric in self.__held[key]:
+                values[metric] = self.__vectors[metric][slot]
+            elif metric in self.__scalars[key]:
+                values[metric] = self.__scalars[key][metric]
+            else:
+                return None
+
+        self.__slots.move_to_end(key)
+
+        return values
+
+    def put(self, chromosome, values, generated=None):
+        """
+        Caches the values of chromosome, a dict of metric to per query vector
+        or scalar. A chromosome evicted before keeps its first generation.
+        """
+        key = _chromosome_to_packed(chromosome)
+        self.__n_genes = len(chromosome)
+
+        if key in self.__slots:
+            slot = self.__slots[key]
+        else:
+            slot = self.__free.pop() if self.__free else len(self.__slots)
+            self.__slots[key] = slot
+            self.__scalars[key] = {}
+            self.__held[key] = set()
+            if key in self.__evicted:
+                generated = self.__evicted.pop(key).get('generated', generated)
+
+        for metric, value in values.items():
+            if np.ndim(value) == 0:
+                self.__scalars[key][metric] = value
+            else:
+                self.__store(metric, slot, value)
+                self.__held[key].add(metric)
+
+        if generated is not None:
+            self.__scalars[key]['generated'] = generated
+
+        self.__slots.move_to_end(key)
+        while self.max_size is not None and len(self.__slots) > self.max_size:
+            self.__evict()
+
+    def set_scalar(self, chromosome, metric, value):
+
+        key = _chromosome_to_packed(chromosome)
+
+        if key in self.__slots:
+            self.__scalars[key][metric] = value
+
+    def __store(self, metric, slot, value):
+
+        vectors = self.__vectors.get(metric)
+
+        if vectors is None or slot >= len(vectors):
+            capacity = max(2 * (0 if vectors is None else len(vectors)), slot + 1)
+            if self.max_size is not None:
+                capacity = min(capacity, self.max_size + 1)
+            grown = np.zeros((capacity, len(value)))
+            if vectors is not None:
+                grown[:len(vectors)] = vectors
+            self.__vectors[metric] = vectors = grown
+
+        vectors[slot] = value
+
+    def __evict(self):
+
+        key, slot = self.__slots.popitem(last=False)
+
+        summary = self.__scalars.pop(key)
+        for metric in self.__held.pop(key):
+            vectors = self.__vectors[metric]
+            summary[metric] = {'mean': float(np.mean(vectors[slot])),
+                               'std': float(np.std(vectors[slot]))}
+
+        self.__evicted[key] = summary
+        self.__free.append(slot)
+
+    def to_dict(self):
+        """
+        JSON serializable bank keyed by '0'/'1' chromosome strings. Evicted
+        chromosomes have {'mean', 'std'} in place of their vectors.
+        """
+        bank = {}
+
+        for key, slot in self.__slots.items():
+            entry = {metric: self.__vectors[metric][slot].tolist()
+                     for metric in self.__held[key]}
+            entry.update(_to_builtin(self.__scalars[key]))
+            bank[self.__packed_to_key(key)] = entry
+
+        for key, summary in self.__evicted.items():
+            bank[self.__packed_to_key(key)] = _to_builtin(summary)
+
+        return bank
+
+    def __packed_to_key(self, key):
+
+        genes = np.unpackbits(np.frombuffer(key, dtype=np.uint8))[:self.__n_genes]
+
+        return ''.join(map(str, genes))
+
+
+def metric_summary(value):
+    """
+    Mean and std of a banked metric, either a per query vector, a scalar or
+    the summary left by an evicted FitnessBank entry.
+    """
+    if isinstance(value, dict):
+        return value['mean'], value['std']
+
+    return np.mean(value), np.std(value)
+
+
+def _to_builtin(values):
+
+    return {name: value.item() if isinstance(value, np.generic) else value
+            for name, value in values.items()}
+
+
+def _chromosome_to_packed(chromosome):
+
+    return np.packbits(np.array([g == '1' or g == 1 for g in chromosome], dtype=bool)).tobytes()
 
 
 def _chromosome_to_key(chromosome):
@@ -1,14 +1,16 @@
 import random
 import numpy as np
+import multiprocessing as mp
+from multiprocessing.connection import wait
 from deap import creator, base, tools, algorithms
-from .misc import _chromosome_to_key
+from .misc import _chromosome_to_key, FitnessBank, DictPersist, metric_summary
 import time
 
 
 
 class GeneticAlgorithmRandomForest():
 
-    def __init__(self, n_trees, evaluator, seed=2567, cx_pb=0.9, ch_mut_pb=0.2, g_mut_pb=0.2, pop_size=75, n_gen=50, tour_size=2, dict_persist=None):
+    def __init__(self, n_trees, evaluator, seed=2567, cx_pb=0.9, ch_mut_pb=0.2, g_mut_pb=0.2, pop_size=75, n_gen=50, tour_size=2, dict_persist=None, bank_size=None):
 
         random.seed(seed)
         np.random.seed(seed)
@@ -22,9 +24,10 @@ class GeneticAlgorithmRandomForest():
         self.__tour_size = tour_size
         self.__dict_persist = dict_persist
         self.__evaluator = evaluator
+        self.__bank_size = bank_size
 
         self.__archive_bank = {}
-        self.__population_bank = {}
+        self.__population_bank = FitnessBank(bank_size)
         self.__pareto_front_bank = {}
         self.__last_gen = 0
 
@@ -71,7 +74,7 @@ class GeneticAlgorithmRandomForest():
     def evolve_model(self, n_gen=0, warm_start=False):
 
         if not warm_start and self.__last_gen != 0:
-            self.__population_bank = {}
+            self.__population_bank = FitnessBank(self.__bank_size)
             self.__archive_bank = {}
             self.__last_gen = 0
             self.__population = self.__toolbox.population(n=self.__pop_size)
@@ -88,16 +91,20 @@ class GeneticAlgorithmRandomForest():
 
             fits_population = self.__toolbox.evaluate(
                 self.__population, bank=self.__population_bank)
-            fits_archive = self.__toolbox.evaluate(
-                self.__archive, bank=self.__population_bank)
 
             for fit, ind in zip(fits_population, self.__population):
                 ind.fitness.values = fit
-            for fit, ind in zip(fits_archive, self.__archive):
-                ind.fitness.values = fit
 
+            # Banked before the archive is evaluated, so its members that were
+            # cloned into the population are not scored a second time
             self.__bank__chromosomes()
 
+            fits_archive = self.__toolbox.evaluate(
+                self.__archive, bank=self.__population_bank)
+
+            for fit, ind in zip(fits_archive, self.__archive):
+                ind.fitness.values = fit
+
             self.__archive = self.__toolbox.select(
                 self.__population + self.__archive, k=self.__pop_size)
 
@@ -120,6 +127,9 @@ class GeneticAlgorithmRandomForest():
                 self.__pareto_front.update(self.__archive)
                 self.__bank_pareto_front()
 
+            # Warm starts carry on from the next generation
+            self.__last_gen = gen + 1
+
         end = time.time()
         self.__elapsed_time = end - start
         self.__persist_data()
@@ -129,6 +139,32 @@ class GeneticAlgorithmRandomForest():
         else:
             return list(self.__pareto_front)
 
+    def get_migrants(self, n_migrants):
+        """
+        n_migrants chromosomes drawn from the archive, each along with its
+        fitness values by metric so the receiving island does not score it.
+        """
+        migrants = random.sample(
+            self.__archive, min(n_migrants, len(self.__archive)))
+
+        return [(list(ind), dict(zip(self.__evaluator.metrics, ind.fitness.values)))
+                for ind in migrants]
+
+    def add_migrants(self, migrants):
+        """
+        Replaces random individuals of the next population with migrants, as
+        given by get_migrants, banking their fitness for the evaluation.
+        """
+        self.__population = list(self.__population)
+
+        positions = random.sample(range(len(self.__population)),
+                                  min(len(migrants), len(self.__population)))
+
+        for position, (chromosome, values) in zip(positions, migrants):
+            self.__population[position] = self.__creator.individual(chromosome)
+            self.__population_bank.put(
+                chromosome, values, generated=self.__last_gen)
+
     def __bank_archive(self):
 
         self.__archive_bank[f'{self.__last_gen}'] = [
@@ -137,14 +173,10 @@ class GeneticAlgorithmRandomForest():
     def __bank__chromosomes(self):
 
         for ind in self.__population:
-            key = _chromosome_to_key(ind)
-            if key in self.__population_bank:
+            if ind in self.__population_bank:
                 continue
-            self.__population_bank[key] = {}
-            for i in range(0, len(self.__evaluator.metrics)):
-                self.__population_bank[key][self.__evaluator.metrics[i]
-                                            ] = ind.fitness.values[i].tolist()
-            self.__population_bank[key]['generated'] = self.__last_gen
+            self.__population_bank.put(
+                ind, dict(zip(self.__evaluator.metrics, ind.fitness.values)), generated=self.__last_gen)
 
     def __bank_pareto_front(self):
 
@@ -156,7 +188,8 @@ class GeneticAlgorithmRandomForest():
         if not self.__dict_persist:
             raise ValueError('Persist object not set')
 
-        self.__dict_persist.save(self.__population_bank, 'population_bank')
+        self.__dict_persist.save(
+            self.__population_bank.to_dict(), 'population_bank')
         self.__dict_persist.save(self.__archive_bank, 'archive_bank')
         self.__dict_persist.save([self.__elapsed_time], 'elapsed_time')
 
@@ -193,4 +226,151 @@ class GeneticAlgorithmRandomForest():
                 if self.__archive[bigger].fitness.values[0] < ind.fitness.values[0]:
                     bigger = i
 
-        return _chromosome_to_key(self.__archive[bigger])
\ No newline at end of file
+        return _chromosome_to_key(self.__archive[bigger])
+
+class IslandGeneticAlgorithmRandomForest():
+    """
+    Island model: n_islands GeneticAlgorithmRandomForest populations, each
+    evolved in its own process with its own seed. Every migration_interval
+    generations each island sends n_migrants chromosomes of its archive to
+    the islands it points to in topology, 'ring' (i to i + 1), 'complete'
+    (every other island) or a list with the targets of each island.
+    Migrants travel with their fitness, so they are not scored again.
+
+    Each island persists its data to an island<i> folder of dict_persist,
+    and the merged banks, along with the pareto front of the union of the
+    island fronts (or the best chromosome), are persisted to dict_persist
+    itself in the layout Analyst reads.
+    """
+
+    def __init__(self, n_trees, evaluator, n_islands=4, migration_interval=5, n_migrants=2, topology='ring', seed=2567, dict_persist=None, **kwargs):
+
+        if not dict_persist:
+            raise ValueError('Persist object not set')
+
+        if migration_interval < 1:
+            raise ValueError('Migration interval must be at least one generation')
+
+        self.__n_trees = n_trees
+        self.__evaluator = evaluator
+        self.__n_islands = n_islands
+        self.__migration_interval = migration_interval
+        self.__n_migrants = n_migrants
+        self.__targets = _island_targets(topology, n_islands)
+        self.__seed = seed
+        self.__dict_persist = dict_persist
+        self.__kwargs = kwargs
+        self.__elapsed_time = None
+
+    def evolve_model(self, n_gen=0):
+
+        start = time.time()
+
+        inboxes = [mp.Queue() for _ in range(self.__n_islands)]
+        islands = [mp.Process(target=_evolve_island, args=(
+            island, self.__n_trees, self.__evaluator, self.__seed + island,
+            DictPersist(self.__dict_persist.path / f'island{island}'), n_gen,
+            self.__migration_interval, self.__n_migrants, self.__targets, inboxes, self.__kwargs))
+            for island in range(self.__n_islands)]
+
+        for island in islands:
+            island.start()
+
+        # A failed island would leave its neighbours waiting for migrants
+        pending = list(islands)
+        while pending:
+            wait([island.sentinel for island in pending])
+            for island in [island for island in pending if island.exitcode is not None]:
+                pending.remove(island)
+                if island.exitcode != 0:
+                    for other in pending:
+                        other.terminate()
+                    raise RuntimeError(
+                        f'Island {islands.index(island)} exited with code {island.exitcode}')
+
+        self.__elapsed_time = time.time() - start
+
+        return self.__persist_data()
+
+    def __persist_data(self):
+
+        metrics = self.__evaluator.metrics
+        population_bank, archive_bank, pareto_front_bank, candidates = {}, {}, {}, []
+
+        for island in range(self.__n_islands):
+            persist = DictPersist(self.__dict_persist.path / f'island{island}')
+
+            for key, entry in persist.load('population_bank').items():
+                # Entries an island evicted only keep a summary
+                if key not in population_bank or isinstance(population_bank[key][metrics[0]], dict):
+                    population_bank[key] = entry
+
+            for gen, inds in persist.load('archive_bank').items():
+                archive_bank.setdefault(gen, []).extend(inds)
+
+            if len(metrics) > 1:
+                for gen, inds in persist.load('pareto_front_bank').items():
+                    pareto_front_bank.setdefault(gen, []).extend(inds)
+                candidates.extend(persist.load('pareto_front'))
+            else:
+                candidates.append(persist.load('best_ind'))
+
+        self.__dict_persist.save(population_bank, 'population_bank')
+        self.__dict_persist.save(archive_bank, 'archive_bank')
+        self.__dict_persist.save([self.__elapsed_time], 'elapsed_time')
+
+        # Islands are compared by the mean of their fitness
+        means = {key: [metric_summary(population_bank[key][metric])[0] * weight
+                       for metric, weight in zip(metrics, self.__evaluator.weights)]
+                 for key in set(candidates)}
+
+        if len(metrics) > 1:
+            pareto_front = [key for key in means if not any(
+                _dominates(means[other], means[key]) for other in means)]
+            self.__dict_persist.save(pareto_front, 'pareto_front')
+            self.__dict_persist.save(
+                {gen: list(set(inds)) for gen, inds in pareto_front_bank.items()}, 'pareto_front_bank')
+            return pareto_front
+        else:
+            best = max(means, key=lambda key: means[key][0])
+            self.__dict_persist.save(best, 'best_ind')
+            return best
+
+
+def _island_targets(topology, n_islands):
+
+    if topology == 'ring':
+        return [[(island + 1) % n_islands] for island in range(n_islands)] if n_islands > 1 else [[]]
+    elif topology == 'complete':
+        return [[other for other in range(n_islands) if other != island] for island in range(n_islands)]
+    elif isinstance(topology, (list, tuple)) and len(topology) == n_islands:
+        return [list(targets) for targets in topology]
+    else:
+        raise ValueError(
+            "Topology must be 'ring', 'complete' or a list with the targets of each island")
+
+
+def _evolve_island(island, n_trees, evaluator, seed, dict_persist, n_gen, migration_interval, n_migrants, targets, inboxes, kwargs):
+
+    ga = GeneticAlgorithmRandomForest(
+        n_trees, evaluator, seed=seed, dict_persist=dict_persist, **kwargs)
+
+    n_sources = sum(targets_of.count(island) for targets_of in targets)
+
+    done = 0
+    while done < n_gen:
+        step = min(migration_interval, n_gen - done)
+        ga.evolve_model(step, warm_start=done > 0)
+        done += step
+
+        if done < n_gen:
+            # Every island sends before receiving, so no island waits on a cycle
+            for target in targets[island]:
+                inboxes[target].put(ga.get_migrants(n_migrants))
+            for _ in range(n_sources):
+                ga.add_migrants(inboxes[island].get())
+
+
+def _dominates(a, b):
+
+    return all(x >= y for x, y in zip(a, b)) and any(x > y for x, y in zip(a, b))
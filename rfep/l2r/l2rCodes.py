@@ -1,3 +1,4 @@
+import os
 import sys
 
 import numpy as np
@@ -15,18 +16,29 @@ import time
 from scipy.stats import norm
 # from cuml import LinearRegression as cuLinearRegression
 from scipy import stats
-
-
-def load_L2R_file(TRAIN_FILE_NAME, sparse=False):
-    nLines = 0
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.sparse import csr_matrix
+
+# Size of the pieces L2R files are read in, and from which they are parsed in
+# parallel by load_L2R_file, one wave of _L2R_WAVE_NBYTES at a time
+_L2R_CHUNK_NBYTES = 1 << 22
+_L2R_PARALLEL_NBYTES = 1 << 28
+_L2R_WAVE_NBYTES = 1 << 27
+# Upper bound of the padded score matrix ranked at once by getMetricsQueries
+_RANK_BLOCK_NBYTES = 1 << 25
+# Queries longer than this many times topN are ranked with a partition first
+_PARTIAL_RANK_MIN = 4
+
+
+def load_L2R_file(TRAIN_FILE_NAME, sparse=False, dtype=np.float32, n_jobs=-1, csr=False):
+    # Features are kept in file order, or at their index with sparse. The
+    # number of features is inferred, the known datasets give a minimum.
+    # The file is parsed in chunks of whole lines straight into X; files
+    # larger than _L2R_PARALLEL_NBYTES are split by byte ranges across n_jobs
+    # processes, one wave at a time so only the chunks of a wave wait to be
+    # stored. Values are parsed as float64 and then stored as dtype. With
+    # csr, X is a scipy.sparse.csr_matrix holding only the nonzero values
     nFeatures = 0
-
-    # GETTING THE DIMENSIONALITY
-    trainFile = open(TRAIN_FILE_NAME, "r")
-    for line in trainFile:
-        nLines = nLines + 1
-    trainFile.seek(0)
-
     if '2003_td_dataset' in TRAIN_FILE_NAME:
         nFeatures = 64
     elif 'web10k' in TRAIN_FILE_NAME:
@@ -34,38 +46,141 @@ def load_L2R_file(TRAIN_FILE_NAME, sparse=False):
     elif 'yahoo' in TRAIN_FILE_NAME:
         nFeatures = 700
 
+    # GETTING THE DIMENSIONALITY
+    nLines = countLines(TRAIN_FILE_NAME)
+    nBytes = os.path.getsize(TRAIN_FILE_NAME)
+
     # FILLING IN THE ARRAY
-    x_train = np.zeros((nLines, nFeatures))
+    x_train = np.zeros((0 if csr else nLines, nFeatures), dtype=dtype)
+    xData, xIndices, xRowCounts = [], [], []
     y_train = np.zeros((nLines))
     q_train = np.zeros((nLines))
     iL = 0
 
-    for line in trainFile:
+    nJobs = effective_n_jobs(n_jobs) if nBytes >= _L2R_PARALLEL_NBYTES else 1
+    if nJobs > 1:
+        chunks = iterL2RParallel(TRAIN_FILE_NAME, nBytes, sparse, dtype, nJobs)
+    else:
+        chunks = parseL2RRange(TRAIN_FILE_NAME, 0, nBytes, sparse, lazy=True, dtype=dtype)
+
+    for labels, queries, rows, columns, values in chunks:
+        nRows = len(labels)
+        if len(columns) and columns.max() >= x_train.shape[1]:
+            x_train = np.concatenate((x_train, np.zeros(
+                (x_train.shape[0], columns.max() + 1 - x_train.shape[1]), dtype=dtype)), axis=1)
+        if csr:
+            nonZero = values != 0
+            xData.append(values[nonZero].astype(dtype))
+            xIndices.append(columns[nonZero])
+            xRowCounts.append(np.bincount(rows[nonZero], minlength=nRows))
+        else:
+            x_train[iL + rows, columns] = values
+        y_train[iL:iL + nRows] = labels
+        q_train[iL:iL + nRows] = queries
+        iL = iL + nRows
+
+    if csr:
+        x_train = csrFromRows(xData, xIndices, xRowCounts, x_train.shape[1], dtype)
+    else:
+        x_train = x_train[:iL]
+
+    return x_train, y_train[:iL], q_train[:iL]
+
+
+def csrFromRows(data, indices, rowCounts, nFeatures, dtype):
+    # csr_matrix from consecutive pieces of rows, with 32 bit indices as the
+    # trees require whenever they fit
+    rowCounts = np.concatenate(rowCounts) if rowCounts else np.zeros(0, dtype=int)
+    indptr = np.concatenate(([0], np.cumsum(rowCounts)))
+    indexType = np.int32 if indptr[-1] < np.iinfo(np.int32).max else np.int64
 
-        m = re.search(r"(\d)\sqid:(\d+)\s(.*)\s#.*", line)
+    X = csr_matrix((np.concatenate(data) if data else np.zeros(0, dtype=dtype),
+                    np.concatenate(indices).astype(indexType) if indices else np.zeros(0, dtype=indexType),
+                    indptr.astype(indexType)), shape=(len(rowCounts), nFeatures))
+    X.sum_duplicates()
 
-        featuresList = (re.sub(r"\d*:", "", m.group(3))).split(" ")
-        if sparse:
-            numFeaturesList = (
-                re.sub(r":.?[0-9]+.?[0-9]+\s", " ", m.group(3) + " ")).split(" ")
-        y_train[iL] = m.group(1)
-        q_train[iL] = m.group(2)
+    return X
 
-        colAllFeat = 0
-        colSelFeat = 0
-        for i in featuresList:
-            if True:
-                if sparse:
-                    x_train[iL][int(numFeaturesList[colAllFeat]
-                                    ) - 1] = float(i)
-                else:
-                    x_train[iL][colSelFeat] = float(i)
-                colSelFeat = colSelFeat + 1
-            colAllFeat = colAllFeat + 1
-        iL = iL + 1
 
-    trainFile.close()
-    return x_train, y_train, q_train
+def countLines(fileName):
+    # Number of lines, counting a last line without a line break
+    nLines = 0
+    last = b"\n"
+    with open(fileName, "rb") as trainFile:
+        for chunk in iter(lambda: trainFile.read(_L2R_CHUNK_NBYTES), b""):
+            nLines = nLines + chunk.count(b"\n")
+            last = chunk[-1:]
+
+    return nLines + (last != b"\n")
+
+
+def iterL2RParallel(fileName, nBytes, sparse, dtype, nJobs):
+    # Parsed chunks of the whole file, _L2R_WAVE_NBYTES at a time split in
+    # nJobs byte ranges. Chunks come back compact (see parseL2RRange) and
+    # the next wave only starts once the caller consumed the previous one
+    with Parallel(n_jobs=nJobs) as parallel:
+        for waveStart in range(0, nBytes, _L2R_WAVE_NBYTES):
+            bounds = np.linspace(waveStart, min(waveStart + _L2R_WAVE_NBYTES, nBytes),
+                                 nJobs + 1).astype(int)
+            ranges = parallel(delayed(parseL2RRange)(fileName, start, end, sparse, dtype=dtype)
+                              for start, end in zip(bounds[:-1], bounds[1:]))
+            while ranges:
+                yield from ranges.pop(0)
+
+
+def parseL2RRange(fileName, start, end, sparse=False, lazy=False, dtype=None):
+    # Parsed chunks of the lines starting in the byte range [start, end),
+    # read _L2R_CHUNK_NBYTES at a time. Returns a generator with lazy. With
+    # dtype, values are cast to it and rows and columns to 32 bits, so a
+    # chunk takes 12 bytes per float32 feature instead of 32
+    chunks = iterL2RRange(fileName, start, end, sparse)
+    if dtype is not None:
+        chunks = ((labels, queries, rows.astype(np.int32), columns.astype(np.int32), values.astype(dtype))
+                  for labels, queries, rows, columns, values in chunks)
+
+    return chunks if lazy else list(chunks)
+
+
+def iterL2RRange(fileName, start, end, sparse=False):
+    with open(fileName, "rb") as trainFile:
+        # A line belongs to the range its first byte is in
+        trainFile.seek(max(start - 1, 0))
+        if start > 0:
+            trainFile.readline()
+
+        while trainFile.tell() < end:
+            buffer = trainFile.read(min(_L2R_CHUNK_NBYTES, end - trainFile.tell()))
+            if not buffer.endswith(b"\n"):
+                buffer = buffer + trainFile.readline()
+            yield parseL2RLines(buffer, sparse)
+
+
+def parseL2RLines(buffer, sparse=False):
+    # Labels, query ids and the features of the lines of buffer as (rows,
+    # columns, values) relative to its first line. Lines are
+    # "label qid:id index:value ... #comment"
+    labels = []
+    queries = []
+    counts = []
+    features = []
+    for line in buffer.split(b"\n"):
+        fields = line.split(b"#", 1)[0].split()
+        if not fields:
+            continue
+        labels.append(fields[0])
+        queries.append(fields[1][4:])
+        counts.append(len(fields) - 2)
+        features.append(b" ".join(fields[2:]))
+
+    pairs = np.fromstring(b" ".join(features).replace(b":", b" "), sep=" ")
+    counts = np.array(counts, dtype=int)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    if sparse:
+        columns = pairs[0::2].astype(int) - 1
+    else:
+        columns = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return np.array(labels, dtype=float), np.array(queries, dtype=float), rows, columns, pairs[1::2]
 
 
 def getNdcgRelScore(dataset, label):
@@ -157,7 +272,7 @@ def ndcg(arrayLabel, dataset):
     return round(NDCGAt10, 4)
 
 
-def getEvaluation(score, listQ, label, trainFile, metric):
+def getDatasetType(trainFile):
     dataset = ""
     if "web10k" in trainFile:
         dataset = "web10k"
@@ -177,36 +292,202 @@ def getEvaluation(score, listQ, label, trainFile, metric):
         print("There is no evaluation to this dataset, dataFile: ", trainFile)
         exit(0)
 
-    listQueries = getQueries(listQ)
+    return dataset
+
+
+def getQueryOffsets(listQ):
+    # Offsets of each run of equal query ids, the same grouping as getQueries,
+    # with the number of documents appended so query q is offsets[q]:offsets[q + 1]
+    listQ = np.asarray(listQ)
+    starts = np.flatnonzero(listQ[1:] != listQ[:-1]) + 1
+
+    return np.concatenate(([0], starts, [len(listQ)])).astype(int)
+
+
+def getQueryBlocks(offsets):
+    # Queries grouped by size up to the next power of two. Each block is ranked
+    # as a matrix padded to its longest query, the padding has label 0
+    sizes = np.diff(offsets)
+    queries = np.flatnonzero(sizes > 0)
+    classes = np.ceil(np.log2(sizes[queries])).astype(int)
+
+    blocks = []
+    for sizeClass in np.unique(classes):
+        blockQueries = queries[classes == sizeClass]
+        columns = np.arange(sizes[blockQueries].max())
+        docs = offsets[blockQueries, np.newaxis] + columns
+        valid = columns < sizes[blockQueries, np.newaxis]
+        blocks.append((blockQueries, np.where(valid, docs, 0), valid))
+
+    return blocks
+
+
+def rankTopN(padded, topN=10):
+    # Columns of the topN smallest values of every row in the same order as
+    # np.argsort(padded, kind="mergesort")[..., :topN], without sorting the
+    # whole row. The partition only gives the topN-th value; everything below
+    # it is taken, then the ties with it in column order until topN are taken,
+    # and only those topN columns are sorted. NaN is ranked last
+    kth = np.partition(padded, topN - 1, axis=-1)[..., topN - 1:topN]
+    kthNan = np.isnan(kth)
+    paddedNan = np.isnan(padded)
+
+    less = (padded < kth) | (~paddedNan & kthNan)
+    ties = (padded == kth) | (paddedNan & kthNan)
+    selected = less | (ties & (np.cumsum(ties, axis=-1) <=
+                               topN - less.sum(axis=-1, keepdims=True)))
+
+    columns = np.nonzero(selected)[-1].reshape(padded.shape[:-1] + (topN,))
+    values = np.take_along_axis(padded, columns, axis=-1)
 
-    lineNum = np.array(range(0, len(label)), dtype=int)
-    mat = (np.vstack((np.reshape(score, -1), np.reshape(lineNum, -1)))).T
-    apQueries = np.array([0.0] * len(listQueries), dtype=float)
-    ndcgQueries = np.array([0.0] * len(listQueries), dtype=float)
+    return np.take_along_axis(columns, np.argsort(values, axis=-1, kind="mergesort"), axis=-1)
+
+
+def dcgAtN(gains):
+    # Same operations and summation order as dcg, one position at a time for all
+    # queries at once
+    vetDCG = gains[..., 0].astype(float)
+    for iPos in range(1, gains.shape[-1]):
+        if (iPos < 2):
+            vetDCG = vetDCG + gains[..., iPos]
+        else:
+            vetDCG = vetDCG + \
+                (gains[..., iPos] * math.log(2) / math.log(iPos + 1))
+    return vetDCG
+
+
+def dcgAtK(rankedLabels, sizes, dataset, k=10):
+    # DCG@k as in ndcg, 0 for queries with less than k documents
+    if rankedLabels.shape[-1] < k:
+        return np.zeros(rankedLabels.shape[:-1])
+
+    relScores = getNdcgRelScore(dataset, np.arange(5 if dataset == "web10k" else 3))
+    gains = relScores[rankedLabels[..., :k]]
+    gains[..., sizes < k, :] = 0
+
+    return dcgAtN(gains)
+
+
+def averagePrecision(rankedLabels, sizes, dataset, k=None):
+    # Same as average_precision over the first k documents, or all of them
+    rankedLabels = rankedLabels[..., :k]
+    relevant = rankedLabels > (1 if dataset == "web10k" else 0)
+    numRelevant = np.cumsum(relevant, axis=-1)
+    precision = np.where(relevant, numRelevant / np.arange(1.0, rankedLabels.shape[-1] + 1), 0)
+
+    avgPrecision = np.zeros(rankedLabels.shape[:-1])
+    np.divide(np.cumsum(precision, axis=-1)[..., -1], numRelevant[..., -1], out=avgPrecision,
+              where=numRelevant[..., -1] != 0)
+
+    return np.round(avgPrecision, 4)
+
+
+def errAtK(rankedLabels, sizes, dataset, k=10):
+    # Expected reciprocal rank over the first k documents, the probability of
+    # stopping at a document is (2^label - 1) / 2^maxLabel
+    maxLabel = 4 if dataset == "web10k" else 2
+    stop = (2.0 ** rankedLabels[..., :k] - 1) / 2 ** maxLabel
+    reach = np.cumprod(1 - stop, axis=-1)
+    reach = np.concatenate((np.ones(reach.shape[:-1] + (1,)), reach[..., :-1]), axis=-1)
+    err = np.cumsum(reach * stop / np.arange(1.0, stop.shape[-1] + 1), axis=-1)[..., -1]
+
+    return np.round(err, 4)
+
+
+# Per query metrics: name -> (function, default k). None ranks every document.
+# ndcg is dcg divided by the dcg of the ideal ranking
+QUERY_METRICS = {
+    "ndcg": (dcgAtK, 10),
+    "dcg": (dcgAtK, 10),
+    "map": (averagePrecision, None),
+    "err": (errAtK, 10),
+}
+
+
+def parseMetric(metric):
+    # "ndcg", "ndcg@5", "map", "err@20"... -> (name, k)
+    name, _, k = metric.lower().partition("@")
+    if name not in QUERY_METRICS:
+        raise ValueError(f'Unknown metric {metric}')
+
+    return name, int(k) if k else QUERY_METRICS[name][1]
+
+
+def getMetricsQueries(score, offsets, label, dataset, metrics, blocks=None, idealDCG=None, partial=True):
+    # Every metric of metrics for every query, from a single ranking of each
+    # query by descending score. Ties keep the document order and NaN goes last,
+    # as the mergesort in the per query implementation. A (n_rankings x n_docs)
+    # score matrix gives (n_rankings x n_queries) matrices. blocks and idealDCG,
+    # a dict of k -> ideal dcg@k, only depend on the evaluation set and can be
+    # reused. With partial, long queries only rank the documents the metrics use
+    if blocks is None:
+        blocks = getQueryBlocks(offsets)
+    if idealDCG is None:
+        idealDCG = {}
+
+    parsed = [parseMetric(metric) for metric in metrics]
+    depths = [k for _, k in parsed]
+    depth = None if None in depths else max(depths)
+
+    score = np.asarray(score)
+    nDocs = offsets[-1]
+    matrix = score.ndim > 1 and score.shape[-1] == nDocs
+    scores = np.reshape(score, (-1, nDocs)) if matrix else np.reshape(score, (1, -1))
+    label = np.asarray(label).astype(int)
+    sizes = np.diff(offsets)
+
+    values = [np.zeros((scores.shape[0], len(sizes))) for _ in metrics]
+    for blockQueries, docs, valid in blocks:
+        width = docs.shape[1]
+        blockDepth = width if depth is None else min(depth, width)
+        blockLabels = np.where(valid, label[docs], 0)
+
+        # Padding is NaN so it is ranked after every document of the query
+        step = max(1, _RANK_BLOCK_NBYTES // (docs.size * 8))
+        for start in range(0, scores.shape[0], step):
+            padded = np.where(valid, -scores[start:start + step, docs], np.nan)
+            if partial and width > _PARTIAL_RANK_MIN * blockDepth:
+                ranked = rankTopN(padded, blockDepth)
+            else:
+                ranked = np.argsort(padded, axis=-1, kind="mergesort")[..., :blockDepth]
+            rankedLabels = np.take_along_axis(
+                np.broadcast_to(blockLabels, padded.shape), ranked, axis=-1)
+
+            for value, (name, k) in zip(values, parsed):
+                value[start:start + step, blockQueries] = QUERY_METRICS[name][0](
+                    rankedLabels, sizes[blockQueries], dataset, k)
+
+    for i, (name, k) in enumerate(parsed):
+        if name == "ndcg":
+            if k not in idealDCG:
+                idealDCG[k] = getIdealDcg(offsets, label, dataset, k, blocks)
+            NDCGAtN = np.zeros(values[i].shape)
+            np.divide(values[i], idealDCG[k], out=NDCGAtN,
+                      where=np.broadcast_to(idealDCG[k] != 0, NDCGAtN.shape))
+            values[i] = np.round(NDCGAtN, 4)
+
+    return {metric: value if matrix else value[0] for metric, value in zip(metrics, values)}
+
+
+def getIdealDcg(offsets, label, dataset, topN=10, blocks=None):
+    # DCG@topN of every query ranked by its own labels, the NDCG denominator
+    label = np.asarray(label).astype(int)
+
+    return getMetricsQueries(label, offsets, label, dataset, [f'dcg@{topN}'], blocks)[f'dcg@{topN}']
+
+
+def getEvaluation(score, listQ, label, trainFile, metric):
+    # Mean and per query values of metric, any of QUERY_METRICS
+    dataset = getDatasetType(trainFile)
+
+    metricQueries = getMetricsQueries(
+        score, getQueryOffsets(listQ), label, dataset, [metric])[metric]
 
-    idQ = 0
     MAP = 0
-    for query in listQueries:
-        matQuery = mat[query]
-        matQuery = matQuery[np.argsort(-matQuery[:, 0], kind="mergesort")]
-        labelQuery = np.array([0] * matQuery.shape[0], dtype=int)
-
-        i = 0
-        for doc in matQuery:
-            labelQuery[i] = label[int(doc[1])]
-            i += 1
-
-        apQueries[idQ] = average_precision(labelQuery, dataset)
-        # print apQueries[idQ]
-        ndcgQueries[idQ] = ndcg(labelQuery, dataset)
-        # print "NDCG", ndcgQueries[idQ]
-        idQ += 1
-
-    if "NDCG" in metric or "ndcg" in metric:
-        for predic in ndcgQueries:
-            MAP = MAP + predic
-
-    return MAP / idQ, ndcgQueries
+    for predic in metricQueries:
+        MAP = MAP + predic
+
+    return MAP / len(metricQueries), metricQueries
     # return ndcgQueries, apQueries
 
 
@@ -453,40 +734,38 @@ def getGeoRisk(mat, alpha):
     # IMPORTANT
     # This function takes a matrix of number of rows as a number of queries, and the number of collumns as the number of systems.
     ##############
-    numSystems = mat.shape[1]
-    numQueries = mat.shape[0]
-    Tj = np.array([0.0] * numQueries)
-    Si = np.array([0.0] * numSystems)
-    geoRisk = np.array([0.0] * numSystems)
-    zRisk = np.array([0.0] * numSystems)
-    mSi = np.array([0.0] * numSystems)
-
-    for i in range(numSystems):
-        Si[i] = np.sum(mat[:, i])
-        mSi[i] = np.mean(mat[:, i])
-
-    for j in range(numQueries):
-        Tj[j] = np.sum(mat[j, :])
-
-    N = np.sum(Tj)
-
-    for i in range(numSystems):
-        tempZRisk = 0
-        for j in range(numQueries):
-            eij = Si[i] * (Tj[j] / N)
-            xij_eij = mat[j, i] - eij
-            if eij != 0:
-                ziq = xij_eij / math.sqrt(eij)
-            else:
-                ziq = 0
-            if xij_eij < 0:
-                ziq = (1 + alpha) * ziq
-            tempZRisk = tempZRisk + ziq
-        zRisk[i] = tempZRisk
-
-    c = numQueries
-    for i in range(numSystems):
-        ncd = norm.cdf(zRisk[i] / c)
-        geoRisk[i] = math.sqrt((Si[i] / c) * ncd)
-
-    return geoRisk
+    mat = np.asarray(mat, dtype=float)
+    Tj = np.sum(mat, axis=1)
+
+    return geoRiskFromTotals(mat, Tj, np.sum(Tj), alpha)
+
+
+def getGeoRiskBatch(candidates, baseTj, alpha):
+    # GeoRisk of every candidate column (queries x candidates) as if it was the
+    # only one added to a fixed set of baseline systems, given the baselines
+    # row totals baseTj = np.sum(baselines, axis=1), computed once for all batches
+    candidates = np.asarray(candidates, dtype=float)
+    baseTj = np.asarray(baseTj, dtype=float)
+
+    Tj = baseTj[:, np.newaxis] + candidates
+
+    return geoRiskFromTotals(candidates, Tj, np.sum(baseTj) + np.sum(candidates, axis=0), alpha)
+
+
+def geoRiskFromTotals(mat, Tj, N, alpha):
+    # GeoRisk of the columns of mat given the query totals Tj and grand total N
+    # of the whole system matrix. Tj is either one column for every system or
+    # one column per system of mat
+    Si = np.sum(mat, axis=0)
+    Tj = np.reshape(Tj, (mat.shape[0], -1))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        eij = Si * (Tj / N)
+    xij_eij = mat - eij
+    ziq = np.zeros(mat.shape)
+    np.divide(xij_eij, np.sqrt(eij, where=eij > 0, out=np.ones(mat.shape)), out=ziq, where=eij != 0)
+    ziq = np.where(xij_eij < 0, (1 + alpha) * ziq, ziq)
+    zRisk = np.sum(ziq, axis=0)
+
+    c = mat.shape[0]
+    return np.sqrt((Si / c) * norm.cdf(zRisk / c))
@@ -1,7 +1,7 @@
 # %%
 from rfep.ga.evaluation import Evaluator
 from rfep.ga.misc import DatasetHandler, ModelPersist, DictPersist
-from rfep.ga.pruning import GeneticAlgorithmRandomForest
+from rfep.ga.pruning import GeneticAlgorithmRandomForest, IslandGeneticAlgorithmRandomForest
 from rfep.ScikitLearnModificado.forest import Forest
 from functools import partial
 from rfep.ga.analisis import Analyst
@@ -14,13 +14,22 @@ folds = [1, 2, 3, 4, 5]
 evolution_set = 'vali'  # str :: Either 'train' or 'vali'. 'train' needs to be used with 'oob_evolution' = True and 'vali' needs it to be False
 oob_evolution = evolution_set == 'train'  # bool :: True if train false if vali
 buffered = True  # bool :: Sets use of buffer in the evolution
+leaf_encoding = False  # bool :: Stores the leaf reached in each tree (1 byte) instead of its prediction in the buffer, so larger forests fit in memory. Requires trees with at most 255 leaves
+delta = True  # bool :: Scores each new chromosome from the closest one already evaluated, only adding and removing the differing trees. Requires 'buffered' = True
 n_gen = 5  # int :: Number of generations to compute
 n_trees = 20  # int :: Size of the ensemble forest
 pop_size = 10  # int :: Size of the population in each generation
 seed = 2567  # int :: Random seed to reproduce similar results, mostly for the forest to be the same. Irrelevant to the evolution
-n_slices = 300 # int :: Number os slices to split the data in order to optimize parallel buffered prediction (Each slice must provide something close to 0.05GB or less)
-
-# list[str] :: List of metrics to use. As of now it is obligatory to contain 'ndcg', but can also contain 'georisk' along with it
+csr = False  # bool :: Loads the datasets as scipy.sparse.csr_matrix keeping only the nonzero features, for high-dimensional mostly-zero collections such as yahoo
+bank_size = 5000  # int or None :: Number of chromosomes whose per query fitness is kept for reuse. The least recently used ones beyond it only keep their mean and std in the population bank. None keeps all of them
+n_jobs = None  # int or None :: Number of worker processes the individuals of each population are scored and ranked in, -1 for all cores. The buffers and datasets are memory mapped by the workers instead of copied. None scores them in this process
+n_islands = None  # int or None :: Number of populations evolved in parallel, one process each, exchanging chromosomes. None evolves a single population
+migration_interval = 5  # int :: Generations between migrations when 'n_islands' is set
+n_migrants = 2  # int :: Chromosomes each island sends to each of its targets per migration
+topology = 'ring'  # str or list[list[int]] :: 'ring' sends from island i to i + 1, 'complete' to every other island, or the list of targets of each island
+n_slices = None # int or None :: Number of slices to split the data in buffered OOB prediction with 'leaf_encoding'. None lets the forest size them from the buffer, the cache size and the available cores. The sparse OOB buffer ignores it
+
+# list[str] :: List of metrics to use. Per query metrics are 'ndcg', 'map' and 'err', optionally at a cutoff as in 'ndcg@5' (ndcg and err default to @10, map to every document). 'georisk' can be added and is computed over the first per query metric, which is also the one the baselines must hold
 objectives = ['ndcg', 'georisk']
 # list[int] :: Needs to be the same size of 'objectives' as represents the weigth of each one of the metrics
 weights = [1, 1]
@@ -32,8 +41,9 @@ run_name = 'test_run'  # str :: Name of the output folder and zipped file
 for fold in folds:
 
     # DatasetHandler take as attr a relative or absolute path to find the dataset
+    # The parsed arrays are cached in a .cache folder next to it and memory mapped on later runs
     train = DatasetHandler(
-        f'data/dataset/{dataset_name}/Fold{fold}/Norm.train.txt')
+        f'data/dataset/{dataset_name}/Fold{fold}/Norm.train.txt', csr=csr)
 
     # This next line loads the dataset in memory
     train.load()
@@ -44,6 +54,8 @@ for fold in folds:
     try:
         # The load method tries to read a forest
         model = mp.load(f'{n_trees}{seed}')
+        # Buffers saved next to a cached forest can be reused
+        reuse_buffers = True
     except:
         # If it fails a new forest is trained and then saved in storage
         model = Forest(
@@ -59,40 +71,89 @@ for fold in folds:
         model.fit(train.X, train.y)
         # By default the forest is saved with n_trees+seed as name
         mp.save(model, f'{n_trees}{seed}')
+        reuse_buffers = False
 
     # Checks which set of the data will be used for evolution to avoid extra loading overhead
     if evolution_set == 'train':
         eset = train
     else:
         eset = DatasetHandler(
-            f'data/dataset/{dataset_name}/Fold{fold}/Norm.{evolution_set}.txt')
+            f'data/dataset/{dataset_name}/Fold{fold}/Norm.{evolution_set}.txt', csr=csr)
         eset.load()
 
     # Checks which prediction strategy will be used and partially apply the method so that the last parameter is the chromosome
     if oob_evolution:
         if buffered:
-            # This next line creates the buffer
-            model.oob_predict_buffer(train.X, train.y)
-
-            p_method = partial(model.oob_buffered_predict, n_slices)
+            encoding = 'leaf' if leaf_encoding else 'sparse'
+
+            # The OOB buffer is created once per forest and memory mapped back from storage on later runs
+            try:
+                if not reuse_buffers:
+                    raise ValueError('Forest was retrained')
+                model.set_oob_buffer(
+                    mp.load_buffer(f'{n_trees}{seed}.oob.{encoding}'))
+            except ValueError:
+                model.oob_predict_buffer(train.X, train.y, encoding=encoding, check_input=False)
+                mp.save_buffer(model.get_oob_buffer(),
+                               f'{n_trees}{seed}.oob.{encoding}')
+                # Mapped back from storage so evaluation workers attach to the file
+                model.set_oob_buffer(
+                    mp.load_buffer(f'{n_trees}{seed}.oob.{encoding}'))
+
+            p_method = partial(model.oob_buffered_predict, n_slices=n_slices)
+            pop_method = model.oob_buffered_predict_population
+            c_method = model.oob_buffered_columns
         else:
-            p_method = partial(model.oob_predict, train.X, train.y)
+            p_method = partial(model.oob_predict, train.X, train.y, check_input=False)
     else:
-        p_method = partial(model.predict, eset.X)
+        if buffered:
+            encoding = 'leaf' if leaf_encoding else 'dense'
+
+            # The per-tree predictions over the evolution set are computed once and memory mapped back from storage on later runs
+            try:
+                if not reuse_buffers:
+                    raise ValueError('Forest was retrained')
+                model.set_predict_buffer(
+                    mp.load_buffer(f'{n_trees}{seed}.{evolution_set}.{encoding}'))
+            except ValueError:
+                model.predict_buffer(eset.X, encoding=encoding, check_input=False)
+                mp.save_buffer(model.get_predict_buffer(),
+                               f'{n_trees}{seed}.{evolution_set}.{encoding}')
+                # Mapped back from storage so evaluation workers attach to the file
+                model.set_predict_buffer(
+                    mp.load_buffer(f'{n_trees}{seed}.{evolution_set}.{encoding}'))
+
+            p_method = model.buffered_predict
+            pop_method = model.buffered_predict_population
+            c_method = model.buffered_columns
+        else:
+            p_method = partial(model.predict, eset.X, check_input=False)
 
     # The evaluator class takes care of the evaluation
     ev = Evaluator(objectives, weights,
-                   dataset_name, eset.X, eset.y, eset.query_id)
+                   dataset_name, eset.X, eset.y, eset.query_id, n_jobs=n_jobs)
 
     # Passing the method onto the evaluator object
     ev.set_predict_method(p_method)
 
+    # Buffered strategies can also score the whole population in a single pass
+    if buffered:
+        ev.set_population_predict_method(pop_method)
+
+        if delta:
+            ev.set_columns_method(c_method)
+
     # DictPersist is necessary for outputting the data generated in evolution
     dp = DictPersist(f'output/{run_name}/Fold{fold}')
 
     # Instantiating the evolution class
-    ga = GeneticAlgorithmRandomForest(
-        n_trees, ev, dict_persist=dp, pop_size=pop_size, seed=seed)
+    if n_islands:
+        ga = IslandGeneticAlgorithmRandomForest(
+            n_trees, ev, n_islands=n_islands, migration_interval=migration_interval, n_migrants=n_migrants,
+            topology=topology, dict_persist=dp, pop_size=pop_size, seed=seed, bank_size=bank_size)
+    else:
+        ga = GeneticAlgorithmRandomForest(
+            n_trees, ev, dict_persist=dp, pop_size=pop_size, seed=seed, bank_size=bank_size)
 
     # Evolve for n_gen!
     ga.evolve_model(n_gen)
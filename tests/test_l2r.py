@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from rfep.l2r.l2rCodes import rankTopN, getMetricsQueries, getQueryOffsets, ndcg
+
+
+@pytest.mark.parametrize('topN', [1, 3, 10, 25])
+def test_rank_top_n_matches_stable_argsort(topN):
+
+    rng = np.random.RandomState(0)
+    # Few distinct values so most rows have ties, plus signed zeros, inf and NaN
+    pool = np.array([-0.0, 0.0, 1.0, -1.0, 0.5, np.inf, -np.inf, np.nan])
+    padded = rng.choice(pool, size=(4, 50, 40))
+
+    expected = np.argsort(padded, axis=-1, kind="mergesort")[..., :topN]
+
+    np.testing.assert_array_equal(rankTopN(padded, topN), expected)
+
+
+@pytest.mark.parametrize('dataset, n_labels', [('web10k', 5), ('letor', 3)])
+def test_metrics_queries_ndcg_matches_per_query_ndcg(dataset, n_labels):
+
+    rng = np.random.RandomState(1)
+    # Long queries go through the partial ranking, short ones through argsort
+    sizes = rng.randint(1, 400, 60)
+    queries = np.repeat(np.arange(len(sizes)), sizes)
+    label = rng.randint(0, n_labels, len(queries))
+    score = np.round(rng.rand(len(queries)), 1)
+
+    offsets = getQueryOffsets(queries)
+    values = getMetricsQueries(score, offsets, label, dataset, ['ndcg'])['ndcg']
+
+    expected = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        order = np.argsort(-score[start:end], kind="mergesort")
+        expected.append(ndcg(label[start:end][order], dataset))
+
+    np.testing.assert_array_equal(values, expected)